@@ -0,0 +1,68 @@
+import os
+from sqlalchemy import select, delete, insert, func, or_
+from sqlalchemy.orm import Session
+
+from Tracks import LibraryFile, FileSummary
+from ScanObjects import CatalogGeneration, CatalogAggregate
+from Base import get_engine
+
+# Totals over present files, grouped by a FileSummary column
+SUMMARY_AGGREGATES = {"video_codec": FileSummary.video_codec, "audio_codec": FileSummary.audio_codec,
+                      "container": FileSummary.container_format, "video_height": FileSummary.video_height}
+AGGREGATES = tuple(SUMMARY_AGGREGATES) + ("folder", "duplicates")
+
+def _present():
+    return or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False)
+
+def refresh_aggregates(engine=None):
+    # Rebuilds CatalogAggregate with a few GROUP BY queries in one transaction and
+    # returns the generation the totals are current for
+    engine = engine if engine is not None else get_engine()
+    with Session(engine) as session:
+        generation = CatalogGeneration.current(session)
+        rows = []
+        for name, column in SUMMARY_AGGREGATES.items():
+            for value, files, size, duration in session.execute(
+                    select(column, func.count(), func.sum(LibraryFile.size), func.sum(FileSummary.duration))
+                    .join(LibraryFile, FileSummary.file_key==LibraryFile.id).where(_present()).group_by(column)):
+                rows.append({"aggregate": name, "key": "" if value is None else str(value), "files": files,
+                             "bytes": size, "duration": duration, "generation": generation})
+        # Files directly in each directory, rolled up to subtrees when queried
+        for path, files, size in session.execute(select(LibraryFile.path, func.count(), func.sum(LibraryFile.size))
+                                                 .where(_present()).group_by(LibraryFile.path)):
+            rows.append({"aggregate": "folder", "key": path, "files": files, "bytes": size, "duration": None,
+                         "generation": generation})
+        # One row per set of identical files, bytes being what removing all but one copy frees
+        for md5, files, size in session.execute(select(LibraryFile.md5, func.count(), func.min(LibraryFile.size))
+                                                .where(_present(), LibraryFile.md5.is_not(None))
+                                                .group_by(LibraryFile.md5).having(func.count()>1)):
+            rows.append({"aggregate": "duplicates", "key": md5, "files": files,
+                         "bytes": (size or 0) * (files - 1), "duration": None, "generation": generation})
+        session.execute(delete(CatalogAggregate))
+        if rows:
+            session.execute(insert(CatalogAggregate), rows)
+        session.commit()
+    return generation
+
+def aggregates_generation(session):
+    # Every row carries the generation of the last refresh, None before the first one
+    return session.scalar(select(CatalogAggregate.generation).limit(1))
+
+def load_aggregate(session, name):
+    return session.execute(select(CatalogAggregate.key, CatalogAggregate.files, CatalogAggregate.bytes,
+                                  CatalogAggregate.duration).where(CatalogAggregate.aggregate==name)).all()
+
+def roll_up_folders(rows, path_prefix, depth=1):
+    # Sums per-directory rows into the subtrees depth levels below path_prefix
+    path_prefix = path_prefix.rstrip(os.sep) or os.sep
+    prefix = path_prefix.rstrip(os.sep) + os.sep
+    totals = {}
+    for key, files, size, _ in rows:
+        if key != path_prefix and not key.startswith(prefix):
+            continue
+        parts = [part for part in key[len(prefix):].split(os.sep) if part][:depth] if key != path_prefix else []
+        bucket = os.path.join(path_prefix, *parts)
+        total = totals.setdefault(bucket, [0, 0])
+        total[0] += files
+        total[1] += size or 0
+    return sorted(((bucket, files, size) for bucket, (files, size) in totals.items()), key=lambda row: -row[2])
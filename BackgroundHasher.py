@@ -0,0 +1,158 @@
+import os
+import time
+import argparse
+import threading
+import logging
+import logging.config
+from datetime import datetime
+from sqlalchemy import select, update, or_
+from sqlalchemy.orm import Session
+
+from Tracks import LibraryFile
+from ScanObjects import HashProgress, CatalogGeneration
+from Base import get_engine
+from Migrations import ensure_schema
+from Hashing import md5_file
+
+logger = logging.getLogger('BackgroundHasher')
+
+class RateLimiter:
+    # Sleeps as needed to keep the average read rate under bytes_per_second
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self._start = time.monotonic()
+        self._consumed = 0
+
+    def __call__(self, nbytes):
+        if not self.bytes_per_second:
+            return
+        self._consumed += nbytes
+        ahead = self._consumed / self.bytes_per_second - (time.monotonic() - self._start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+class BackgroundHasher:
+    # Fills in md5 for files ingested with a fingerprint only. Progress is stored in
+    # HashProgress after every batch, so an interrupted run resumes where it stopped.
+    JOB_NAME = "md5"
+
+    def __init__(self, bytes_per_second=None, batch_size=20):
+        self._limiter = RateLimiter(bytes_per_second)
+        self._batch_size = batch_size
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def start(self, **kwargs):
+        thread = threading.Thread(target=self.run, kwargs=kwargs, name="BackgroundHasher", daemon=True)
+        thread.start()
+        return thread
+
+    def _load_progress(self, session):
+        progress = session.get(HashProgress, self.JOB_NAME)
+        if progress is None:
+            progress = HashProgress(job=self.JOB_NAME, last_file_id=0, files_hashed=0, bytes_hashed=0)
+            session.add(progress)
+        return progress
+
+    def run(self, max_files=None, max_seconds=None):
+        ensure_schema()
+        deadline = time.monotonic() + max_seconds if max_seconds else None
+        hashed = 0
+        with Session(get_engine()) as session:
+            progress = self._load_progress(session)
+            last_id = progress.last_file_id
+            wrapped = last_id == 0
+            while not self._stop.is_set():
+                rows = session.execute(select(LibraryFile.id, LibraryFile.path, LibraryFile.name,
+                                              LibraryFile.size, LibraryFile.mtime_ns)
+                                       .where(LibraryFile.md5.is_(None), LibraryFile.id>last_id,
+                                              or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False))
+                                       .order_by(LibraryFile.id).limit(self._batch_size)).all()
+                # No transaction stays open while the batch is hashed
+                session.commit()
+                if not rows:
+                    if wrapped:
+                        last_id = 0
+                        break
+                    # Rescans may have reset md5 on files below the resume point
+                    last_id = 0
+                    wrapped = True
+                    continue
+                digests = []
+                for row in rows:
+                    last_id = row.id
+                    md5 = self._hash_one(row)
+                    if md5 is not None:
+                        digests.append((row, md5))
+                    if self._stop.is_set() or (max_files and hashed + len(digests) >= max_files) \
+                            or (deadline and time.monotonic() >= deadline):
+                        self._stop.set()
+                        break
+                # The batch is written in one short transaction, so the write lock is
+                # only held for the UPDATEs and never while files are read
+                hashed += self._store(session, digests, progress)
+                progress.last_file_id = last_id
+                progress.updated = datetime.now()
+                session.commit()
+            progress.last_file_id = last_id
+            progress.updated = datetime.now()
+            session.commit()
+        logger.info("Hashed %d files", hashed)
+        return hashed
+
+    def _hash_one(self, row):
+        # The file's md5, None when it could not be hashed or changed since it was scanned
+        file_path = os.path.join(row.path, row.name)
+        try:
+            st = os.stat(file_path)
+            if (st.st_size, st.st_mtime_ns) != (row.size, row.mtime_ns):
+                # Changed since ingest, the next scan will refresh it
+                logger.debug("Skipping %s, changed since it was scanned", file_path)
+                return None
+            md5 = md5_file(file_path, self._limiter)
+            st = os.stat(file_path)
+        except OSError as e:
+            logger.warning("Could not hash %s: %s", file_path, e)
+            return None
+        if (st.st_size, st.st_mtime_ns) != (row.size, row.mtime_ns):
+            logger.debug("Skipping %s, modified while hashing", file_path)
+            return None
+        return md5
+
+    def _store(self, session, digests, progress):
+        # Returns the number of rows that took their hash
+        hashed_ids = []
+        for row, md5 in digests:
+            # Only fill the hash if the scanner has not touched the row in the meantime
+            result = session.execute(update(LibraryFile)
+                                     .where(LibraryFile.id==row.id, LibraryFile.md5.is_(None),
+                                            LibraryFile.size==row.size, LibraryFile.mtime_ns==row.mtime_ns)
+                                     .values(md5=md5))
+            if result.rowcount:
+                hashed_ids.append(row.id)
+                progress.files_hashed += 1
+                progress.bytes_hashed += row.size
+        if hashed_ids:
+            session.execute(update(LibraryFile).where(LibraryFile.id.in_(hashed_ids))
+                            .values(generation=CatalogGeneration.bump(session)))
+        return len(hashed_ids)
+
+def parse_rate(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B/S")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Compute deferred md5 hashes for files ingested with --fast-hash")
+    parser.add_argument("--rate", type=parse_rate, help="maximum read rate, e.g. 50M (bytes per second)")
+    parser.add_argument("--batch-size", type=int, default=20, help="files hashed per commit")
+    parser.add_argument("--max-files", type=int, help="stop after hashing this many files")
+    parser.add_argument("--max-seconds", type=float, help="stop after running this long")
+    args = parser.parse_args()
+    BackgroundHasher(args.rate, args.batch_size).run(args.max_files, args.max_seconds)
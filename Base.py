@@ -1,18 +1,151 @@
 import os
+import threading
+import configparser
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import create_engine, Sequence
+from sqlalchemy import create_engine, event, Sequence, make_url
 
 WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
 
-ENGINE_TYPE = "sqlite"
+# Database settings. Each key can be set in the [database] section of the file named
+# by MEDIALIBRARY_CONFIG (default: medialibrary.conf next to the sources), overridden
+# by a MEDIALIBRARY_DB_<KEY> environment variable, and finally by configure().
+DEFAULT_CONFIG = {
+    "url": "sqlite:///" + os.path.join(WORKING_DIR, "library.db"),
+    "echo": "false",
+    # Pool settings, ignored by SQLite in-memory databases
+    "pool_size": "5",
+    "max_overflow": "10",
+    "pool_timeout": "30",
+    "pool_recycle": "3600",
+    # Applied to every new SQLite connection
+    "sqlite_journal_mode": "WAL",
+    "sqlite_synchronous": "NORMAL",
+    "sqlite_mmap_size": str(256 * 1024**2),
+    "sqlite_cache_size": str(-64 * 1024),
+    "sqlite_busy_timeout": "30000",
+    "sqlite_temp_store": "MEMORY",
+    # Set to ON by processes that must never write, e.g. QueryService.py
+    "sqlite_query_only": "",
+    # Ids each process reserves per round trip, doubling up to id_max_block_size while
+    # ids are consumed quickly. With a sequence, blocks are whole multiples of its increment.
+    "id_block_size": "100",
+    "id_max_block_size": "100000",
+}
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout", "temp_store", "query_only")
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_engine("sqlite:///" + os.path.join(WORKING_DIR, "library.db"), echo=True)
+# Used for ids on backends with sequences; SQLite and backends without sequences
+# (e.g. MySQL) use the Id_Sequence table instead
+ID_SEQUENCE = Sequence("id_seq", metadata=Base.metadata, start=1, increment=100)
 
-if ENGINE_TYPE == "sqlite":
-    from SqliteObjects import Id_Sequence
-    id_seq = Id_Sequence()
-else:
-    id_seq = Sequence("id_seq",metadata=Base.metadata, start=1, increment=100)
\ No newline at end of file
+_lock = threading.RLock()
+_overrides = {}
+_config = None
+_engine = None
+_id_seq = None
+
+def load_config():
+    config = dict(DEFAULT_CONFIG)
+    parser = configparser.ConfigParser()
+    parser.read(os.environ.get("MEDIALIBRARY_CONFIG", os.path.join(WORKING_DIR, "medialibrary.conf")))
+    if parser.has_section("database"):
+        config.update((key, value) for key, value in parser.items("database") if key in DEFAULT_CONFIG)
+    for key in DEFAULT_CONFIG:
+        value = os.environ.get("MEDIALIBRARY_DB_" + key.upper())
+        if value is not None:
+            config[key] = value
+    config.update((key, str(value)) for key, value in _overrides.items())
+    return config
+
+def configure(**settings):
+    # Overrides settings for this process, e.g. configure(url="postgresql://...", echo=True).
+    # An engine that was already created is disposed and rebuilt on next use.
+    global _config, _engine, _id_seq
+    unknown = set(settings) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError("Unknown database settings: %s" % ", ".join(sorted(unknown)))
+    with _lock:
+        _overrides.update(settings)
+        if _engine is not None:
+            _engine.dispose()
+        _config = None
+        _engine = None
+        _id_seq = None
+
+def get_config():
+    global _config
+    with _lock:
+        if _config is None:
+            _config = load_config()
+        return _config
+
+def engine_type():
+    return make_url(get_config()["url"]).get_backend_name()
+
+def get_engine():
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _lock:
+        if _engine is None:
+            _engine = _create_engine(get_config())
+        return _engine
+
+def uses_id_table(dialect):
+    return dialect.name == "sqlite" or not dialect.supports_sequences
+
+def get_id_seq():
+    global _id_seq
+    if _id_seq is not None:
+        return _id_seq
+    with _lock:
+        if _id_seq is None:
+            config = get_config()
+            block_size, max_block_size = int(config["id_block_size"]), int(config["id_max_block_size"])
+            if uses_id_table(get_engine().dialect):
+                from SqliteObjects import Id_Sequence
+                _id_seq = Id_Sequence(block_size, max_block_size)
+            else:
+                from IdAllocator import SequenceIdAllocator
+                _id_seq = SequenceIdAllocator(ID_SEQUENCE, get_engine(), block_size, max_block_size)
+        return _id_seq
+
+def _reset_after_fork():
+    # A forked child must neither use the parent's pooled connections nor hand out
+    # ids from the block the parent reserved
+    global _lock, _id_seq
+    _lock = threading.RLock()
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _id_seq = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _create_engine(config):
+    url = make_url(config["url"])
+    options = {"echo": _as_bool(config["echo"])}
+    in_memory = url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+    if not in_memory:
+        options.update(pool_size=int(config["pool_size"]), max_overflow=int(config["max_overflow"]),
+                       pool_timeout=float(config["pool_timeout"]), pool_recycle=int(config["pool_recycle"]))
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"timeout": int(config["sqlite_busy_timeout"]) / 1000}
+    else:
+        options["pool_pre_ping"] = True
+    engine = create_engine(url, **options)
+    if url.get_backend_name() == "sqlite":
+        pragmas = [(pragma, config["sqlite_" + pragma]) for pragma in SQLITE_PRAGMAS
+                   if config["sqlite_" + pragma] != "" and not (in_memory and pragma == "journal_mode")]
+        event.listen(engine, "connect", lambda dbapi_connection, record: _set_pragmas(dbapi_connection, pragmas))
+    return engine
+
+def _set_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas:
+        cursor.execute("PRAGMA %s=%s" % (pragma, value))
+    cursor.close()
+
+def _as_bool(value):
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import logging
+
+# Scan throughput benchmark. Builds a synthetic library, then times a full scan,
+# a no-op rescan and a rescan after a few changes. MediaInfo can be replaced by
+# stub_parse so that walk, hashing and DB costs are measured without libmediainfo.
+# Each backend is benchmarked in a child process with its own engine and id allocator.
+
+MEDIA_EXTENSIONS = (".mkv", ".mp4", ".avi")
+NON_MEDIA_EXTENSIONS = (".nfo", ".srt", ".sfv")
+# Bytes read by stub_parse, roughly what libmediainfo reads from a typical file
+STUB_READ_BYTES = 256 * 1024
+
+STUB_GENERAL = """<track type="General"><Format>{format}</Format><Codec>{format}</Codec><File_size>{size}</File_size>
+<Duration>{duration}</Duration><File_name>{name}</File_name><Folder_name>{folder}</Folder_name>
+<File_extension>{extension}</File_extension><Stream_identifier>0</Stream_identifier>
+<Count_of_video_streams>1</Count_of_video_streams><Count_of_audio_streams>1</Count_of_audio_streams></track>"""
+STUB_STREAMS = """<track type="Video"><Track_ID>1</Track_ID><Format>HEVC</Format><Codec>V_MPEGH</Codec>
+<Width>{width}</Width><Height>{height}</Height><Duration>{duration}</Duration><Bit_depth>10</Bit_depth></track>
+<track type="Audio"><Track_ID>2</Track_ID><Format>AAC</Format><Codec>A_AAC</Codec><Channel_s_>{channels}</Channel_s_>
+<Duration>{duration}</Duration><Sampling_rate>48000</Sampling_rate></track>"""
+
+def stub_parse(filename, buffer_size=64 * 1024, **kwargs):
+    # Deterministic stand-in for MediaInfo.parse, accepting a path or a file object and output="OLDXML"
+    from pymediainfo import MediaInfo
+    if hasattr(filename, "read"):
+        f = filename
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(0)
+        remaining = STUB_READ_BYTES
+        while remaining > 0 and f.read(min(buffer_size, remaining)):
+            remaining -= buffer_size
+        file_path = f.name
+    else:
+        file_path = os.fspath(filename)
+        size = os.path.getsize(file_path)
+        with open(file_path, 'rb') as f:
+            f.read(STUB_READ_BYTES)
+    folder, base_name = os.path.split(file_path)
+    name, extension = os.path.splitext(base_name)
+    fields = {"size": size, "name": name, "folder": folder, "extension": extension[1:],
+              "format": extension[1:].upper() or "Unknown", "duration": size % 10000000 + 60000,
+              "width": 3840 if size % 2 else 1920, "height": 2160 if size % 2 else 1080, "channels": 2 + size % 7}
+    tracks = STUB_GENERAL.format(**fields)
+    if extension.lower() in MEDIA_EXTENSIONS:
+        tracks += STUB_STREAMS.format(**fields)
+    xml = '<?xml version="1.0" encoding="UTF-8"?><Mediainfo><File>%s</File></Mediainfo>' % tracks
+    if kwargs.get("output") == "OLDXML":
+        return xml
+    return MediaInfo(xml)
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+def _write_file(file_path, size, rng, sparse):
+    with open(file_path, 'wb') as f:
+        if sparse and size > 16384:
+            # Random head and tail keep hashes distinct without writing every byte
+            f.write(rng.randbytes(8192))
+            f.seek(size - 8192)
+            f.write(rng.randbytes(8192))
+        else:
+            f.write(rng.randbytes(size))
+
+def generate_library(root, files=1000, size_median=4 * 1024**2, size_sigma=1.0, min_size=1024, max_size=1024**3,
+                     depth=3, fanout=4, non_media_share=0.25, seed=0, sparse=False):
+    # Returns a description of the generated tree: directories, media/non-media paths and bytes
+    rng = random.Random(seed)
+    directories = [root]
+    level = [root]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                directory = os.path.join(parent, "dir%d_%d" % (d, i))
+                os.makedirs(directory, exist_ok=True)
+                next_level.append(directory)
+        directories.extend(next_level)
+        level = next_level
+    library = {"directories": directories, "media": [], "non_media": [], "bytes": 0}
+    for i in range(files):
+        directory = rng.choice(directories)
+        if rng.random() < non_media_share:
+            file_path = os.path.join(directory, "extra%06d%s" % (i, rng.choice(NON_MEDIA_EXTENSIONS)))
+            with open(file_path, 'w') as f:
+                f.write("sidecar %d\n" % i)
+            library["non_media"].append(file_path)
+        else:
+            size = int(min(max(rng.lognormvariate(0, size_sigma) * size_median, min_size), max_size))
+            file_path = os.path.join(directory, "media%06d%s" % (i, rng.choice(MEDIA_EXTENSIONS)))
+            _write_file(file_path, size, rng, sparse)
+            library["media"].append(file_path)
+            library["bytes"] += size
+    return library
+
+def apply_changes(library, count=10, seed=1, sparse=False):
+    # Modifies, adds, renames and deletes `count` media files each; returns bytes needing ingest
+    rng = random.Random(seed)
+    media = library["media"]
+    changed_bytes = 0
+    for file_path in rng.sample(media, min(count, len(media))):
+        with open(file_path, 'ab') as f:
+            f.write(b"changed")
+        changed_bytes += os.path.getsize(file_path)
+    for i in range(count):
+        file_path = os.path.join(rng.choice(library["directories"]), "added%06d.mkv" % i)
+        size = rng.randint(1024, 4 * 1024**2)
+        _write_file(file_path, size, rng, sparse)
+        media.append(file_path)
+        changed_bytes += size
+    for file_path in rng.sample(media, min(count, len(media))):
+        target = os.path.join(rng.choice(library["directories"]), "renamed_" + os.path.basename(file_path))
+        os.rename(file_path, target)
+        media[media.index(file_path)] = target
+    for file_path in rng.sample(media, min(count, len(media))):
+        os.remove(file_path)
+        media.remove(file_path)
+    return changed_bytes
+
+def _timed_scan(name, root, scanner_options, file_count, ingest_bytes):
+    from FileScanner import FileScanner
+    scanner = FileScanner(root, progress_interval=0, **scanner_options)
+    start = time.perf_counter()
+    scanner.scan()
+    seconds = time.perf_counter() - start
+    return {"scenario": name, "seconds": round(seconds, 3), "files": file_count,
+            "files_per_second": round(file_count / seconds, 1) if seconds else None,
+            "mb_per_second": round(ingest_bytes / 1024**2 / seconds, 1) if seconds else None,
+            "bytes_read": scanner.stats.counters["bytes_read"],
+            "stages": {stage: round(seconds, 3) for stage, seconds in scanner.stats.stage_seconds.items()}}
+
+def run_benchmark(args, db_url):
+    import Base
+    Base.configure(url=db_url, echo=False)
+    import FileScanner
+    logging.getLogger('FileScanner').setLevel(logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix="medialibrary-bench-", dir=args.work_dir)
+    try:
+        root = os.path.join(work_dir, "library")
+        os.makedirs(root)
+        start = time.perf_counter()
+        library = generate_library(root, args.files, args.size_median, args.size_sigma, args.min_size, args.max_size,
+                                   args.depth, args.fanout, args.non_media_share, args.seed, args.sparse)
+        generate_seconds = time.perf_counter() - start
+        options = {"workers": args.workers, "use_processes": args.processes, "bulk": args.bulk,
+                   "fast_hash": args.fast_hash, "single_pass": args.single_pass, "archive": not args.no_archive,
+                   "parser": None if args.real_parser else stub_parse}
+        file_count = len(library["media"]) + len(library["non_media"])
+        results = [_timed_scan("full scan", root, options, file_count, library["bytes"])]
+        rescan_options = dict(options, quick=args.quick)
+        results.append(_timed_scan("no-op rescan", root, rescan_options, file_count, 0))
+        changed_bytes = apply_changes(library, args.changes, args.seed + 1, args.sparse)
+        file_count = len(library["media"]) + len(library["non_media"])
+        results.append(_timed_scan("rescan after %d changes" % args.changes, root, rescan_options, file_count, changed_bytes))
+        return {"backend": Base.get_engine().url.render_as_string(hide_password=True),
+                "generate_seconds": round(generate_seconds, 3), "library_bytes": library["bytes"],
+                "options": {key: value for key, value in options.items() if key != "parser"},
+                "stub_parser": not args.real_parser, "results": results}
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_results(report, out=sys.stdout):
+    out.write("backend: %s  library: %.1f MB  options: %s\n" % (report["backend"], report["library_bytes"] / 1024**2, report["options"]))
+    out.write("%-28s %10s %8s %10s %10s\n" % ("scenario", "seconds", "files", "files/s", "MB/s"))
+    for result in report["results"]:
+        out.write("%-28s %10.3f %8d %10s %10s\n" % (result["scenario"], result["seconds"], result["files"],
+                                                     result["files_per_second"], result["mb_per_second"]))
+        # Worker stages (parse, hash) are summed over workers and can exceed the wall clock time
+        out.write("    %s\n" % "  ".join("%s %.3f" % (stage, seconds) for stage, seconds in result["stages"].items() if seconds))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FileScanner on a synthetic library")
+    parser.add_argument("--files", type=int, default=1000, help="number of files to generate")
+    parser.add_argument("--size-median", type=parse_size, default="4M", help="median media file size")
+    parser.add_argument("--size-sigma", type=float, default=1.0, help="log-normal spread of media file sizes")
+    parser.add_argument("--min-size", type=parse_size, default="1K")
+    parser.add_argument("--max-size", type=parse_size, default="1G")
+    parser.add_argument("--depth", type=int, default=3, help="directory nesting depth")
+    parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory")
+    parser.add_argument("--non-media-share", type=float, default=0.25, help="fraction of sidecar files")
+    parser.add_argument("--changes", type=int, default=10, help="files modified/added/renamed/deleted before the last rescan")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sparse", action="store_true", help="write sparse media files (fast to create, fast to read)")
+    parser.add_argument("--work-dir", help="where to create the synthetic library (default: system temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic library afterwards")
+    parser.add_argument("--db-url", action="append",
+                        help="database URL to benchmark, may be repeated (default: a scratch SQLite file). "
+                             "Use a scratch database, rows are added to it")
+    parser.add_argument("--real-parser", action="store_true", help="use libmediainfo instead of the stub parser")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("--bulk", action="store_true")
+    parser.add_argument("--fast-hash", action="store_true")
+    parser.add_argument("--single-pass", action="store_true")
+    parser.add_argument("--quick", action="store_true", help="use quick mode for the rescans")
+    parser.add_argument("--no-archive", action="store_true", help="do not archive raw MediaInfo output")
+    parser.add_argument("--json", help="also write the reports to this file")
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_output:
+        # One backend per process, so id blocks and pools never carry over between runs
+        report = run_benchmark(args, args.db_url[0])
+        with open(args.child_output, 'w') as f:
+            json.dump(report, f)
+        return
+    scratch = tempfile.mkdtemp(prefix="medialibrary-bench-db-")
+    db_urls = args.db_url or ["sqlite:///" + os.path.join(scratch, "bench.db")]
+    child_output = os.path.join(scratch, "report.json")
+    reports = []
+    try:
+        for db_url in db_urls:
+            command = [sys.executable, os.path.realpath(__file__), "--db-url=" + db_url, "--child-output=" + child_output]
+            subprocess.run(command + _strip_option_values(sys.argv[1:]), check=True)
+            with open(child_output) as f:
+                report = json.load(f)
+            print_results(report)
+            reports.append(report)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+def _strip_option_values(argv):
+    # Drops --db-url/--json (and their values) from the arguments passed to a child run
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("--db-url", "--json"):
+            skip = True
+        elif not arg.startswith(("--db-url=", "--json=")):
+            stripped.append(arg)
+    return stripped
+
+if __name__ == "__main__":
+    main()
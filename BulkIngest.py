@@ -0,0 +1,66 @@
+import time
+from collections import defaultdict
+from sqlalchemy import insert
+
+from Base import Base
+from Tracks import LibraryFile, FileSummary
+from ScanObjects import IgnoredFile, RawMediaInfo
+
+class BulkInserter:
+    # Buffers new rows per table and writes them with one executemany insert per table
+    def __init__(self):
+        self._rows = defaultdict(list)
+        self.file_count = 0
+        self.row_count = 0
+
+    def add_file(self, name, path, md5, stat_result, media_info, fingerprint=None, raw=None):
+        file_row = LibraryFile.row(name, path, md5, stat_result, fingerprint)
+        self._add(LibraryFile.__table__, file_row)
+        for table, track_row in LibraryFile.track_rows(file_row["id"], media_info):
+            self._add(table, track_row)
+        self._add(FileSummary.__table__, FileSummary.row(file_row["id"], media_info))
+        if raw is not None:
+            self._add(RawMediaInfo.__table__, RawMediaInfo.row(file_row["id"], stat_result, raw))
+        self.file_count += 1
+
+    def add_ignored(self, name, path, stat_result, reason):
+        self._add(IgnoredFile.__table__, IgnoredFile.row(name, path, stat_result, reason))
+        self.file_count += 1
+
+    def _add(self, table, row):
+        self._rows[table].append(row)
+        self.row_count += 1
+
+    @property
+    def pending_files(self):
+        return len(self._rows.get(LibraryFile.__table__, ()))
+
+    def flush(self, session, generation=None):
+        # Parent tables first so foreign keys hold on backends that enforce them
+        for row in self._rows.get(LibraryFile.__table__, ()):
+            row["generation"] = generation
+        for table in Base.metadata.sorted_tables:
+            rows = self._rows.pop(table, None)
+            if rows:
+                session.execute(insert(table), rows)
+        self.file_count = 0
+        self.row_count = 0
+
+class CommitPolicy:
+    # Decides when a batching writer should commit: every N files or every M seconds
+    def __init__(self, max_files=1000, max_seconds=30.0):
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self.reset()
+
+    def reset(self):
+        self.files = 0
+        self.started = time.monotonic()
+
+    def add(self, count=1):
+        self.files += count
+
+    def due(self):
+        if self.files == 0:
+            return False
+        return self.files >= self.max_files or time.monotonic() - self.started >= self.max_seconds
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import argparse
+import logging
+import logging.config
+from collections import namedtuple, defaultdict
+from itertools import groupby, repeat
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, update, func, or_
+from sqlalchemy.orm import Session
+
+from Tracks import LibraryFile, GeneralTrack
+from ScanObjects import CatalogGeneration
+from Base import get_engine
+from Migrations import ensure_schema
+from Hashing import md5_file, partial_hash
+
+logger = logging.getLogger('Duplicates')
+
+DuplicateFile = namedtuple("DuplicateFile", ["id", "path", "name"])
+DuplicateSet = namedtuple("DuplicateSet", ["size", "md5", "files"])
+
+class DuplicateFinder:
+    # Tiered duplicate detection: files are grouped by size in SQL, size collisions
+    # are split by a head/tail partial hash, and only groups that still collide
+    # are compared by full md5 (stored, or computed and written back).
+    def __init__(self, path_prefix=None, min_size=1, workers=1):
+        self._path_prefix = path_prefix
+        self._min_size = min_size
+        self._workers = max(1, workers)
+        self.stats = defaultdict(int)
+
+    def _candidates(self, session):
+        # The stat size is preferred; rows scanned before it was recorded fall back to MediaInfo's file_size
+        file_size = select(func.max(GeneralTrack.file_size)).where(GeneralTrack.file_key==LibraryFile.id).scalar_subquery()
+        sized = select(LibraryFile.id.label("id"), func.coalesce(LibraryFile.size, file_size).label("size")) \
+            .where(or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False))
+        if self._path_prefix is not None:
+            sized = sized.where(or_(LibraryFile.path==self._path_prefix,
+                                    LibraryFile.path.startswith(self._path_prefix.rstrip(os.sep) + os.sep, autoescape=True)))
+        sized = sized.subquery()
+        dup_sizes = select(sized.c.size).where(sized.c.size>=self._min_size) \
+            .group_by(sized.c.size).having(func.count()>1).subquery()
+        stmt = select(sized.c.size, LibraryFile.id, LibraryFile.path, LibraryFile.name, LibraryFile.md5) \
+            .join(sized, sized.c.id==LibraryFile.id) \
+            .join(dup_sizes, dup_sizes.c.size==sized.c.size) \
+            .order_by(sized.c.size)
+        return session.execute(stmt)
+
+    def _hash_all(self, pool, hash_function, rows):
+        run = pool.map if pool is not None else map
+        hashes = run(_safe_hash, repeat(hash_function), [os.path.join(row.path, row.name) for row in rows])
+        return list(zip(rows, hashes))
+
+    def find(self):
+        ensure_schema()
+        duplicates = []
+        computed_md5 = {}
+        pool = ThreadPoolExecutor(max_workers=self._workers) if self._workers > 1 else None
+        try:
+            with Session(get_engine()) as session:
+                for size, rows in groupby(self._candidates(session), key=lambda row: row.size):
+                    rows = list(rows)
+                    self.stats["size_groups"] += 1
+                    self.stats["size_candidates"] += len(rows)
+                    if all(row.md5 for row in rows):
+                        # Every member already has a full hash, no disk access needed
+                        groups = [rows]
+                    else:
+                        groups = defaultdict(list)
+                        for row, digest in self._hash_all(pool, partial_hash, rows):
+                            self.stats["partial_hashed"] += 1
+                            if digest is not None:
+                                groups[digest].append(row)
+                        groups = groups.values()
+                    for group in groups:
+                        if len(group) < 2:
+                            continue
+                        by_md5 = defaultdict(list)
+                        unhashed = [row for row in group if not row.md5]
+                        for row, digest in self._hash_all(pool, md5_file, unhashed):
+                            self.stats["full_hashed"] += 1
+                            if digest is not None:
+                                computed_md5[row.id] = digest
+                                by_md5[digest].append(row)
+                        for row in group:
+                            if row.md5:
+                                by_md5[row.md5].append(row)
+                        for md5, members in by_md5.items():
+                            if len(members) > 1:
+                                duplicates.append(DuplicateSet(size, md5, [DuplicateFile(row.id, row.path, row.name) for row in members]))
+            if computed_md5:
+                with Session(get_engine()) as session:
+                    generation = CatalogGeneration.bump(session)
+                    session.execute(update(LibraryFile), [{"id": file_id, "md5": md5, "generation": generation}
+                                                          for file_id, md5 in computed_md5.items()])
+                    session.commit()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        logger.info("Found %d duplicate sets: %s", len(duplicates), dict(self.stats))
+        return duplicates
+
+def _safe_hash(hash_function, file_path):
+    try:
+        return hash_function(file_path)
+    except OSError as e:
+        logger.warning("Could not hash %s: %s", file_path, e)
+        return None
+
+def find_duplicates(path_prefix=None, min_size=1, workers=1):
+    return DuplicateFinder(path_prefix, min_size, workers).find()
+
+def print_report(duplicate_sets, out=sys.stdout):
+    reclaimable = 0
+    for duplicate_set in sorted(duplicate_sets, key=lambda d: d.size * (len(d.files) - 1), reverse=True):
+        wasted = duplicate_set.size * (len(duplicate_set.files) - 1)
+        reclaimable += wasted
+        out.write("%s  %d files x %d bytes (%d reclaimable)\n" % (duplicate_set.md5, len(duplicate_set.files), duplicate_set.size, wasted))
+        for file in duplicate_set.files:
+            out.write("    %s\n" % os.path.join(file.path, file.name))
+    out.write("%d duplicate sets, %d bytes reclaimable\n" % (len(duplicate_sets), reclaimable))
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Report duplicate files in the media library")
+    parser.add_argument("--path", help="only consider files below this directory")
+    parser.add_argument("--min-size", type=int, default=1, help="ignore files smaller than this many bytes")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of hashing threads")
+    parser.add_argument("--json", action="store_true", help="write the report as JSON")
+    args = parser.parse_args()
+    path_prefix = os.path.abspath(os.path.expanduser(args.path)) if args.path else None
+    duplicate_sets = find_duplicates(path_prefix, args.min_size, args.workers)
+    if args.json:
+        json.dump([{"size": d.size, "md5": d.md5, "files": [os.path.join(f.path, f.name) for f in d.files]}
+                   for d in duplicate_sets], sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print_report(duplicate_sets)
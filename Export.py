@@ -0,0 +1,229 @@
+import os
+import sys
+import csv
+import json
+import argparse
+import contextlib
+import logging
+import logging.config
+from sqlalchemy import select, or_, Integer, BigInteger, Float, Boolean
+from sqlalchemy.orm import Session
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from Tracks import LibraryFile, GeneralTrack, VideoTrack, AudioTrack, ImageTrack
+from ScanObjects import CatalogGeneration
+from Base import get_engine
+from Migrations import ensure_schema
+from Queries import track_loaders
+from Reconcile import under_path
+
+logger = logging.getLogger('Export')
+
+# Files held in memory at a time, each batch costs one SELECT per track table
+EXPORT_BATCH_SIZE = 1000
+FORMATS = ("jsonl", "csv", "parquet")
+TRACK_TYPES = (("general", GeneralTrack, "general_tracks"), ("video", VideoTrack, "video_tracks"),
+               ("audio", AudioTrack, "audio_tracks"), ("image", ImageTrack, "image_tracks"))
+FILE_COLUMNS = [column.key for column in LibraryFile.__table__.columns]
+
+def _flat_columns():
+    # File columns, the track type, then every track column once. A column whose type
+    # differs between track tables is exported as text.
+    types = {column.key: column.type for column in LibraryFile.__table__.columns}
+    types["track_type"] = None
+    for _, track_class, _ in TRACK_TYPES:
+        for column in track_class.__table__.columns:
+            if column.key in ("id", "file_key") or column.key in FILE_COLUMNS:
+                continue
+            if column.key in types and type(types[column.key]) is not type(column.type):
+                types[column.key] = None
+            else:
+                types.setdefault(column.key, column.type)
+    return types
+
+FLAT_TYPES = _flat_columns()
+FLAT_COLUMNS = list(FLAT_TYPES)
+
+def _track_values(track):
+    return {column.key: getattr(track, column.key) for column in track.__table__.columns
+            if column.key not in ("id", "file_key")}
+
+def export_record(library_file):
+    # One JSON object per file with its tracks nested by type
+    record = {key: getattr(library_file, key) for key in FILE_COLUMNS}
+    record["tracks"] = {track_type: [_track_values(track) for track in getattr(library_file, attribute)]
+                        for track_type, _, attribute in TRACK_TYPES}
+    return record
+
+def flat_rows(library_file):
+    # One row per track with the file's columns repeated, one row for a file without tracks
+    file_values = {key: getattr(library_file, key) for key in FILE_COLUMNS}
+    rows = []
+    for track_type, _, attribute in TRACK_TYPES:
+        for track in getattr(library_file, attribute):
+            row = dict.fromkeys(FLAT_COLUMNS)
+            row.update(file_values)
+            row["track_type"] = track_type
+            row.update((key, value if FLAT_TYPES[key] is not None or value is None else str(value))
+                       for key, value in _track_values(track).items())
+            rows.append(row)
+    if not rows:
+        row = dict.fromkeys(FLAT_COLUMNS)
+        row.update(file_values)
+        rows.append(row)
+    return rows
+
+def iter_batches(session, since=None, path_prefix=None, include_missing=True, batch_size=EXPORT_BATCH_SIZE):
+    # Streams files with their tracks in batches of batch_size. Files come from one
+    # server-side cursor (yield_per), tracks from one SELECT per table and batch, and
+    # each batch is expunged once the caller is done with it, so memory stays flat.
+    stmt = select(LibraryFile).options(*track_loaders()).order_by(LibraryFile.id)
+    if since is not None:
+        stmt = stmt.where(LibraryFile.generation>since)
+    if path_prefix is not None:
+        stmt = stmt.where(under_path(LibraryFile.path, path_prefix))
+    if not include_missing:
+        stmt = stmt.where(or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False))
+    for files in session.scalars(stmt.execution_options(yield_per=batch_size)).partitions():
+        yield files
+        # expunge_all() would invalidate the identity map the open cursor still loads into
+        for library_file in files:
+            for _, _, attribute in TRACK_TYPES:
+                for track in getattr(library_file, attribute):
+                    session.expunge(track)
+            if library_file.summary is not None:
+                session.expunge(library_file.summary)
+            session.expunge(library_file)
+
+class JsonLinesWriter:
+    binary = False
+
+    def __init__(self, out):
+        self._out = out
+
+    def write(self, files):
+        self._out.writelines(json.dumps(export_record(library_file), separators=(",", ":")) + "\n"
+                             for library_file in files)
+
+    def close(self):
+        pass
+
+class CsvWriter:
+    binary = False
+
+    def __init__(self, out):
+        self._writer = csv.DictWriter(out, FLAT_COLUMNS)
+        self._writer.writeheader()
+
+    def write(self, files):
+        for library_file in files:
+            self._writer.writerows(flat_rows(library_file))
+
+    def close(self):
+        pass
+
+class ParquetWriter:
+    # One row group per batch
+    binary = True
+
+    def __init__(self, out):
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self._schema = pyarrow.schema([(key, _arrow_type(column_type)) for key, column_type in FLAT_TYPES.items()])
+        self._writer = pyarrow.parquet.ParquetWriter(out, self._schema)
+
+    def write(self, files):
+        rows = [row for library_file in files for row in flat_rows(library_file)]
+        if rows:
+            self._writer.write_table(pyarrow.Table.from_pylist(rows, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+def _arrow_type(column_type):
+    if isinstance(column_type, (Integer, BigInteger)):
+        return pyarrow.int64()
+    if isinstance(column_type, Float):
+        return pyarrow.float64()
+    if isinstance(column_type, Boolean):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+def export(out, format="jsonl", since=None, path_prefix=None, include_missing=True, batch_size=EXPORT_BATCH_SIZE):
+    # Writes the catalog, or with since only files changed in later generations, to out.
+    # Returns (files, tracks, generation); pass generation as since to the next
+    # incremental export. It is read before the export starts, so changes committed
+    # meanwhile are exported again next time rather than missed.
+    ensure_schema()
+    files = tracks = 0
+    with Session(get_engine()) as session:
+        generation = CatalogGeneration.current(session)
+        writer = WRITERS[format](out)
+        for batch in iter_batches(session, since, path_prefix, include_missing, batch_size):
+            writer.write(batch)
+            files += len(batch)
+            tracks += sum(len(getattr(library_file, attribute)) for library_file in batch for _, _, attribute in TRACK_TYPES)
+            logger.debug("Exported %d files", files)
+        writer.close()
+    logger.info("Exported %d files with %d tracks%s, catalog generation %d", files, tracks,
+                " changed since generation %d" % since if since is not None else "", generation)
+    return files, tracks, generation
+
+def _logs_to_stderr():
+    # For exports to stdout: a logging config that logs there would mix log lines into the data
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    for handler in {handler for logger in loggers for handler in logger.handlers}:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+
+@contextlib.contextmanager
+def _output(file_path, binary):
+    # Written under a temporary name, so consumers never pick up a partial export
+    if file_path is None:
+        yield sys.stdout.buffer if binary else sys.stdout
+        return
+    tmp_path = "%s.%d.tmp" % (file_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb' if binary else 'w', newline=None if binary else '') as f:
+            yield f
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Export the media library catalog with its tracks")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="jsonl",
+                        help="jsonl nests tracks per file; csv and parquet write one row per track")
+    parser.add_argument("-o", "--output", help="output file (default: standard output, not for parquet)")
+    parser.add_argument("--since", type=int, help="only files changed after this catalog generation")
+    parser.add_argument("--checkpoint", help="file holding the generation of the previous export; read as --since "
+                                             "when present and updated after a successful export")
+    parser.add_argument("--path", help="only export files below this directory")
+    parser.add_argument("--exclude-missing", action="store_true", help="leave out files missing on disk")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="files fetched per batch")
+    args = parser.parse_args()
+    if args.format == "parquet" and args.output is None:
+        parser.error("parquet export needs --output")
+    since = args.since
+    if since is None and args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as f:
+            since = int(f.read().strip())
+    path_prefix = os.path.abspath(os.path.expanduser(args.path)) if args.path else None
+    if args.output is None:
+        _logs_to_stderr()
+    with _output(args.output, WRITERS[args.format].binary) as out:
+        files, tracks, generation = export(out, args.format, since, path_prefix, not args.exclude_missing, args.batch_size)
+    if args.checkpoint:
+        with _output(args.checkpoint, False) as f:
+            f.write("%d\n" % generation)
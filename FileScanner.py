@@ -1,47 +1,743 @@
 import os
+import stat
+import time
+import argparse
 import logging
 import logging.config
+from itertools import chain
+from collections import deque, defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from pymediainfo import MediaInfo
-from sqlalchemy import select
+from sqlalchemy import select, delete, update, func
 from sqlalchemy.orm import Session
 
-from Tracks import LibraryFile
-from Base import engine
+from Tracks import LibraryFile, stat_signature
+from ScanObjects import IgnoredFile, DirectoryIndex, RawMediaInfo, QuarantinedFile, CatalogGeneration
+from Base import get_engine
+from Migrations import ensure_schema
+from Hashing import md5_file, fingerprint_file, files_signature, HashingReader, \
+    HASH_CHUNK_SIZE, PARTIAL_BLOCK_SIZE, FINGERPRINT_SAMPLES
+from BulkIngest import BulkInserter, CommitPolicy
+from Reconcile import Reconciler, in_tree
+from ScanStats import ScanStats, profiled
+from MediaInfoArchive import compress_xml, fill_path_fields
+from ParseWorkers import IsolatedPool, ParseFailed
+from Aggregates import refresh_aggregates
 
-WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
-logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
 logger = logging.getLogger('FileScanner')
 
+# Results queued per worker before the writer has to catch up
+PENDING_PER_WORKER = 4
+
+# Files with these extensions are never handed to libmediainfo
+IGNORED_EXTENSIONS = frozenset((".nfo", ".txt", ".log", ".sfv", ".md5", ".sha1", ".url", ".nzb", ".torrent",
+                                ".par2", ".ini", ".json", ".xml", ".html", ".htm", ".db", ".lnk"))
+# Nor are files with these names (compared lower case), whatever the extensions
+IGNORED_NAMES = frozenset((".ds_store", "thumbs.db", "desktop.ini"))
+# Leading bytes of common non-media formats, checked before libmediainfo is called
+NON_MEDIA_SIGNATURES = (b"%PDF", b"PK\x03\x04", b"Rar!\x1a\x07", b"7z\xbc\xaf\x27\x1c", b"\x1f\x8b",
+                        b"\x7fELF", b"MZ", b"SQLite format 3\x00", b"PAR2\x00PKT", b"<?xml", b"d8:announce")
+SIGNATURE_READ_SIZE = 16
+# DirectoryIndex rows removed per statement once their directories are gone
+STALE_DELETE_BATCH = 500
+# Files in a row that could not be read before the scan gives up, e.g. when a mount went away
+MAX_CONSECUTIVE_READ_ERRORS = 20
+
+# What a scan worker hands back to the writer. media_info is None for files that are
+# not media, with reason saying why; raw is the compressed MediaInfo XML when archiving.
+ProbeResult = namedtuple("ProbeResult", ["media_info", "md5", "fingerprint", "reason", "timings", "raw"])
+
+def probe_file(file_path, non_media_signatures=NON_MEDIA_SIGNATURES, fast_hash=False, single_pass=False, parser=None,
+               archive=False, hashing=True):
+    # Runs in a scan worker: parse and hash, leaving all DB work to the writer.
+    # parser defaults to MediaInfo.parse; benchmarks substitute a deterministic stub.
+    # timings feeds ScanStats.record_probe.
+    # With fast_hash only a sampled fingerprint is taken and md5 is left to BackgroundHasher.
+    # With single_pass the file is opened once and md5 is fed from the bytes libmediainfo reads.
+    # Without hashing the file is only parsed, hash_probe completes the result.
+    single_pass = single_pass and not fast_hash and hashing
+    if parser is None:
+        parser = MediaInfo.parse
+    timings = {"parse": 0.0, "bytes": 0}
+    if not non_media_signatures and not single_pass:
+        return _probe_path(file_path, fast_hash, parser, archive, timings, hashing)
+    start = time.perf_counter()
+    with open(file_path, 'rb') as f:
+        if non_media_signatures:
+            head = f.read(SIGNATURE_READ_SIZE)
+            timings["bytes"] += len(head)
+            if head.startswith(tuple(non_media_signatures)):
+                timings["parse"] += time.perf_counter() - start
+                return ProbeResult(None, None, None, "signature", timings, None)
+            f.seek(0)
+        if not single_pass:
+            timings["parse"] += time.perf_counter() - start
+            return _probe_path(file_path, fast_hash, parser, archive, timings, hashing)
+        reader = HashingReader(f)
+        media_info, raw = _parse(parser, reader, archive, buffer_size=HASH_CHUNK_SIZE)
+        timings["parse"] += time.perf_counter() - start
+        if len(media_info.tracks)<=1:
+            timings["bytes"] += reader.bytes_read
+            return ProbeResult(None, None, None, "no tracks", timings, None)
+        fill_path_fields(media_info, file_path)
+        start = time.perf_counter()
+        md5 = reader.finish()
+        timings["hash"] = time.perf_counter() - start
+        timings["bytes"] += reader.bytes_read
+        return ProbeResult(media_info, md5, None, None, timings, raw)
+
+def _probe_path(file_path, fast_hash, parser, archive, timings, hashing=True):
+    # Bytes libmediainfo reads by itself are not visible here, only hashed bytes are counted
+    start = time.perf_counter()
+    media_info, raw = _parse(parser, file_path, archive)
+    timings["parse"] += time.perf_counter() - start
+    if len(media_info.tracks)<=1:
+        return ProbeResult(None, None, None, "no tracks", timings, None)
+    result = ProbeResult(media_info, None, None, None, timings, raw)
+    return hash_probe(file_path, result, fast_hash) if hashing else result
+
+def hash_probe(file_path, result, fast_hash=False):
+    # Adds the md5 (or with fast_hash the fingerprint) to a media file's probe result
+    if result.media_info is None:
+        return result
+    timings = result.timings
+    start = time.perf_counter()
+    if fast_hash:
+        fingerprint = fingerprint_file(file_path)
+        timings["hash"] = time.perf_counter() - start
+        timings["bytes"] += min(os.path.getsize(file_path), FINGERPRINT_SAMPLES * PARTIAL_BLOCK_SIZE)
+        return result._replace(fingerprint=fingerprint)
+    hashed = []
+    md5 = md5_file(file_path, hashed.append)
+    timings["hash"] = time.perf_counter() - start
+    timings["bytes"] += sum(hashed)
+    return result._replace(md5=md5)
+
+def _parse(parser, source, archive, **kwargs):
+    # Returns (media_info, compressed XML or None). MediaInfo.parse builds its result from
+    # the OLDXML output anyway, so asking for the text costs nothing extra.
+    if not archive:
+        return parser(source, **kwargs), None
+    xml = parser(source, output="OLDXML", **kwargs)
+    media_info = MediaInfo(xml)
+    return media_info, compress_xml(xml) if len(media_info.tracks) > 1 else None
+
+class ScanCancelled(Exception):
+    # Raised out of a scan whose should_stop hook returned True; uncommitted work is dropped
+    pass
+
+def release_quarantined(root_dir, recursive=True, max_attempts=None):
+    # Removes the quarantine entries below root_dir, or only those that failed at most
+    # max_attempts times, so the next scan parses the files again. Returns the count.
+    # The index rows of their directories are invalidated in the same transaction,
+    # otherwise an unchanged directory would be skipped and the files never parsed.
+    criteria = [in_tree(QuarantinedFile.path, root_dir, recursive)]
+    if max_attempts is not None:
+        criteria.append(QuarantinedFile.attempts<=max_attempts)
+    with Session(get_engine()) as session:
+        paths = list(session.scalars(select(QuarantinedFile.path).where(*criteria).distinct()))
+        released = session.execute(delete(QuarantinedFile).where(*criteria)).rowcount
+        for i in range(0, len(paths), STALE_DELETE_BATCH):
+            session.execute(update(DirectoryIndex).where(DirectoryIndex.path.in_(paths[i:i+STALE_DELETE_BATCH]))
+                            .values(mtime_ns=-1, files_signature=""))
+        session.commit()
+    return released
+
+def _run_inline(fn, *args):
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
 class FileScanner:
-    def __init__(self, root_dir: str):
+    def __init__(self, root_dir: str, workers: int = 1, use_processes: bool = False,
+                 ignored_extensions=IGNORED_EXTENSIONS, non_media_signatures=NON_MEDIA_SIGNATURES,
+                 bulk: bool = False, commit_files: int = 1000, commit_seconds: float = 30.0,
+                 fast_hash: bool = False, single_pass: bool = False, quick: bool = False, parser=None,
+                 progress_interval: float = 30.0, archive: bool = True, parse_timeout: float = None,
+                 recursive: bool = True, aggregates: bool = True, should_stop=None):
         abs_root = os.path.abspath(os.path.expanduser(os.path.expandvars(root_dir)))
         if not os.path.isdir(abs_root):
             raise Exception("Invalid Path: %s" % (abs_root))
         self._root_dir = abs_root
-        logger.debug("FileScanner initialized for path: %s", self._root_dir)
+        self._workers = max(1, workers)
+        self._use_processes = use_processes
+        self._ignored_extensions = frozenset(ext.lower() for ext in ignored_extensions or ())
+        self._non_media_signatures = tuple(non_media_signatures or ())
+        self._fast_hash = fast_hash
+        self._single_pass = single_pass
+        if single_pass and parse_timeout:
+            logger.warning("Single pass hashing is not used with a parse timeout, files are hashed after parsing")
+        # Quick rescans do not list directories whose mtime is unchanged, so files
+        # rewritten in place under the same name are only noticed by a full scan
+        self._quick = quick
+        self._parser = parser
+        # Keep the compressed MediaInfo output so track tables can be rebuilt without re-parsing
+        self._archive = archive
+        # With a time budget, every parse runs in a worker process that is killed once it exceeds it.
+        # Hashing stays outside the budget, in scan threads, since it takes as long as the file is large.
+        self._parse_timeout = parse_timeout
+        # Without recursion only the files directly in root_dir are scanned and reconciled
+        self._recursive = recursive
+        # Rebuild the precomputed aggregates after a scan that changed the catalog
+        self._aggregates = aggregates
+        # Called per directory, per file and before every commit; True cancels the scan
+        self._should_stop = should_stop
+        self._session = None
+        # Bulk mode writes new rows with Core executemany and commits on a file/time budget
+        self._bulk = BulkInserter() if bulk else None
+        self._commit_policy = CommitPolicy(commit_files, commit_seconds)
+        # Seconds between progress lines, 0 disables them
+        self._progress_interval = progress_interval
+        self.stats = None
+        logger.debug("FileScanner initialized for path: %s with %d workers", self._root_dir, self._workers)
+
+    def _create_pool(self):
+        if self._parse_timeout:
+            self._parse_pool = IsolatedPool(self._workers, self._parse_timeout)
+            return ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ScanWorker")
+        if self._workers == 1:
+            return None
+        # libmediainfo and hashlib release the GIL, so threads usually suffice
+        if self._use_processes:
+            return ProcessPoolExecutor(max_workers=self._workers)
+        return ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ScanWorker")
+
+    def _start(self, expected_files=None):
+        ensure_schema()
+        if self._parser is None and not MediaInfo.can_parse():
+            # Otherwise every file would fail and be quarantined as if it were broken
+            raise RuntimeError("libmediainfo could not be loaded, install it before scanning")
+        self._parse_pool = None
+        pool = self._create_pool()
+        self._submit = pool.submit if pool is not None else _run_inline
+        self._max_pending = self._workers * PENDING_PER_WORKER
+        self._pending = deque()
+        self._reconciler = Reconciler(self._root_dir, self._recursive)
+        # Quarantined files that changed since they failed and are being parsed again
+        self._retrying = set()
+        # Directories with files that could not be read, listed again by the next scan
+        self._read_errors = set()
+        self._consecutive_read_errors = 0
+        self.stats = ScanStats(self._root_dir, expected_files)
+        return pool
+
+    def _stop(self, pool):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._reconciler.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(cancel_futures=True)
+            self._parse_pool = None
 
     def scan(self):
-        for root, dirs, files in os.walk(self._root_dir):
-            with Session(engine, autoflush=False) as session:
-                logger.info("Scanning for media files in: %s", root)
-                existing_files = session.execute(select(LibraryFile).where(LibraryFile.path==root)).all()
-                existing_filenames = {existing_file[0].name for existing_file in existing_files}
-                logger.debug(existing_filenames)
-                for file in files:
-                    if file in existing_filenames:
+        ensure_schema()
+        with Session(get_engine()) as session:
+            generation = CatalogGeneration.current(session)
+        pool = self._start(self._expected_files())
+        self._load_directory_index()
+        try:
+            # The real parent keeps DirectoryIndex consistent when a subtree is scanned on its own
+            parent = os.path.dirname(self._root_dir)
+            self._scan_directory(self._root_dir, parent if parent != self._root_dir else None)
+            while self._pending:
+                self._write_next(self._pending)
+                self._report_progress()
+            self._commit()
+            self._check_stop()
+            with self.stats.timer("reconcile"):
+                missing, found, stale, released = self._reconciler.reconcile()
+                self._remove_stale_directories()
+            self.stats.count("files_missing", missing)
+            self.stats.count("files_found", found)
+            self.stats.count("ignored_removed", stale)
+            self.stats.count("quarantine_removed", released)
+            if self._aggregates:
+                with Session(get_engine()) as session:
+                    changed = CatalogGeneration.current(session) != generation
+                if changed:
+                    with self.stats.timer("aggregate"):
+                        refresh_aggregates()
+            self.stats.finish()
+            logger.info(self.stats.progress_line())
+            logger.info("Stage times: %s", self.stats.stage_summary())
+            for seconds, file_path in self.stats.slowest_files:
+                logger.debug("Slow file: %s took %.2fs to parse and hash", file_path, seconds)
+        finally:
+            self._stop(pool)
+
+    def _is_ignored(self, name):
+        name = name.lower()
+        return name in IGNORED_NAMES or os.path.splitext(name)[1] in self._ignored_extensions
+
+    def scan_paths(self, paths):
+        # Incremental ingest of individual paths below the root, e.g. from Watcher. Files
+        # go through the same probe and write pipeline as a scan; paths that no longer
+        # exist (files or whole directories) are flagged missing on disk.
+        changed = defaultdict(list)
+        removed = []
+        for path in paths:
+            path = os.path.abspath(path)
+            if self._is_ignored(os.path.basename(path)):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                removed.append(path)
+                continue
+            except OSError as e:
+                logger.warning("Could not stat %s: %s", path, e)
+                continue
+            if stat.S_ISREG(st.st_mode):
+                changed[os.path.dirname(path)].append((os.path.basename(path), st))
+        pool = self._start()
+        try:
+            for root, files in changed.items():
+                self.stats.count("files_seen", len(files))
+                self._scan_files(root, files)
+            while self._pending:
+                self._write_next(self._pending)
+            self._commit()
+            # After the writes, so files moved within the batch are claimed by their new path first
+            with self.stats.timer("reconcile"):
+                self.stats.count("files_missing", self._reconciler.mark_removed(removed))
+            self.stats.finish()
+            logger.info(self.stats.progress_line())
+        finally:
+            self._stop(pool)
+
+    def _expected_files(self):
+        # The catalog size from the previous scan, used for the ETA
+        with Session(get_engine()) as session:
+            count = session.scalar(select(func.count()).select_from(LibraryFile)
+                                   .where(in_tree(LibraryFile.path, self._root_dir, self._recursive)))
+            count += session.scalar(select(func.count()).select_from(IgnoredFile)
+                                    .where(in_tree(IgnoredFile.path, self._root_dir, self._recursive)))
+        return count or None
+
+    def _check_stop(self):
+        if self._should_stop is not None and self._should_stop():
+            raise ScanCancelled("Scan of %s cancelled" % self._root_dir)
+
+    def _report_progress(self):
+        if self.stats.report_due(self._progress_interval):
+            logger.info(self.stats.progress_line())
+
+    def _load_directory_index(self):
+        self._directories = {}
+        self._children = defaultdict(list)
+        self._visited = set()
+        with Session(get_engine()) as session:
+            for directory in session.execute(select(DirectoryIndex.id, DirectoryIndex.path, DirectoryIndex.parent,
+                                                    DirectoryIndex.mtime_ns, DirectoryIndex.entry_count,
+                                                    DirectoryIndex.files_signature)
+                                             .where(in_tree(DirectoryIndex.path, self._root_dir, self._recursive))):
+                self._directories[directory.path] = directory
+                self._children[directory.parent].append(directory.path)
+
+    def _remove_stale_directories(self):
+        stale = [path for path in self._directories if path not in self._visited]
+        if not stale:
+            return
+        with Session(get_engine()) as session:
+            for i in range(0, len(stale), STALE_DELETE_BATCH):
+                session.execute(delete(DirectoryIndex).where(DirectoryIndex.path.in_(stale[i:i+STALE_DELETE_BATCH])))
+            session.commit()
+
+    def _scan_directory(self, path, parent):
+        # Walks the tree depth first
+        self._check_stop()
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            logger.warning("Could not read directory %s: %s", path, e)
+            return
+        self._visited.add(path)
+        self.stats.count("directories")
+        known = self._directories.get(path)
+        if self._quick and known is not None and known.mtime_ns == st.st_mtime_ns:
+            # No entries were added, removed or renamed, so only subdirectories are checked
+            logger.debug("Directory %s unchanged, not listing it", path)
+            self._reconciler.seen_directory(path)
+            self.stats.count("directories_skipped")
+            subdirs = self._children.get(path, ())
+            entry_count = known.entry_count
+            files_digest = known.files_signature
+        else:
+            logger.info("Scanning for media files in: %s", path)
+            files = []
+            subdirs = []
+            entry_count = 0
+            stat_seconds = 0.0
+            start = time.perf_counter()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        entry_count += 1
+                        try:
+                            if entry.is_dir():
+                                if not entry.is_symlink():
+                                    subdirs.append(entry.path)
+                            elif not self._is_ignored(entry.name):
+                                stat_start = time.perf_counter()
+                                files.append((entry.name, entry.stat()))
+                                stat_seconds += time.perf_counter() - stat_start
+                        except OSError:
+                            continue
+            except OSError as e:
+                logger.warning("Could not list directory %s: %s", path, e)
+                return
+            files_digest = files_signature(files)
+            self.stats.add_time("walk", time.perf_counter() - start - stat_seconds)
+            self.stats.add_time("stat", stat_seconds, len(files))
+            self.stats.count("files_seen", len(files))
+            if known is not None and known.files_signature == files_digest:
+                logger.debug("Files in %s unchanged since the last scan", path)
+                self._reconciler.seen_directory(path)
+                self.stats.count("directories_unchanged")
+                self.stats.count("files_unchanged", len(files))
+            else:
+                self._scan_files(path, files)
+        if self._recursive:
+            for subdir in subdirs:
+                self._scan_directory(subdir, path)
+        values = {"path": path, "parent": parent, "mtime_ns": st.st_mtime_ns, "entry_count": entry_count,
+                  "files_signature": files_digest}
+        if known is not None and all(getattr(known, key) == value for key, value in values.items()):
+            values = None
+        self._pending.append(("dir", path, (known.id if known is not None else None, values), None))
+        self._drain()
+
+    def _drain(self):
+        while len(self._pending) > self._max_pending:
+            self._write_next(self._pending)
+        self._report_progress()
+
+    def _scan_files(self, root, files):
+        with Session(get_engine()) as session:
+            lookup_start = time.perf_counter()
+            existing_files = session.execute(select(LibraryFile.name, LibraryFile.size, LibraryFile.mtime_ns,
+                                                    LibraryFile.inode, LibraryFile.device)
+                                             .where(LibraryFile.path==root)).all()
+            ignored_files = session.execute(select(IgnoredFile.name, IgnoredFile.size, IgnoredFile.mtime_ns,
+                                                   IgnoredFile.inode, IgnoredFile.device)
+                                            .where(IgnoredFile.path==root)).all()
+            existing_signatures = {existing_file[0]: tuple(existing_file[1:]) for existing_file in existing_files}
+            quarantined_files = session.execute(select(QuarantinedFile.name, QuarantinedFile.size, QuarantinedFile.mtime_ns,
+                                                       QuarantinedFile.inode, QuarantinedFile.device)
+                                                .where(QuarantinedFile.path==root)).all()
+            ignored_signatures = {ignored_file[0]: tuple(ignored_file[1:]) for ignored_file in ignored_files}
+            quarantined_signatures = {quarantined_file[0]: tuple(quarantined_file[1:]) for quarantined_file in quarantined_files}
+            self.stats.add_time("lookup", time.perf_counter() - lookup_start)
+            for file, st in files:
+                self._check_stop()
+                file_path = os.path.join(root,file)
+                self._reconciler.seen(root, file)
+                if file in quarantined_signatures:
+                    if quarantined_signatures[file] == stat_signature(st):
+                        logger.debug("File %s in directory %s failed to parse and has not changed since, skipping", file, root)
+                        self.stats.count("files_quarantined")
+                        continue
+                    self._retrying.add((root, file))
+                if file in existing_signatures:
+                    old_signature = existing_signatures[file]
+                    if old_signature == stat_signature(st):
                         logger.debug("File %s in directory %s already existing in DB, skipping", file, root)
-                        existing_filenames.remove(file)
+                        self.stats.count("files_unchanged")
+                    elif old_signature[0] is None:
+                        # Row predates stat tracking, record the signature without re-reading the file
+                        self._pending.append(("stat", root, (file, st), None))
+                    else:
+                        logger.debug("File %s in directory %s changed on disk, rescanning", file, root)
+                        self._pending.append(("update", root, (file, st), self._submit_probe(file_path)))
+                elif file in ignored_signatures:
+                    if ignored_signatures[file] == stat_signature(st):
+                        logger.debug("File %s in directory %s is known not to be media, skipping", file, root)
+                        self.stats.count("files_unchanged")
+                    else:
+                        self._pending.append(("ignored", root, (file, st), self._submit_probe(file_path)))
+                else:
+                    with self.stats.timer("lookup"):
+                        moved_id = self._reconciler.find_moved(session, file_path, st)
+                    if moved_id is not None:
+                        self._pending.append(("move", root, (file, st, moved_id), None))
+                    else:
+                        self._pending.append(("file", root, (file, st), self._submit_probe(file_path)))
+                self._drain()
+
+    def _submit_probe(self, file_path):
+        if self._parse_pool is not None:
+            return self._submit(self._isolated_probe, file_path)
+        return self._submit(probe_file, file_path, self._non_media_signatures, self._fast_hash, self._single_pass,
+                            self._parser, self._archive)
+
+    def _isolated_probe(self, file_path):
+        # Runs in a scan thread: only the parse goes to a worker process under the time
+        # budget, the file is hashed here. A single pass would put hashing under the budget.
+        result = self._parse_pool.submit(probe_file, file_path, self._non_media_signatures, self._fast_hash, False,
+                                         self._parser, self._archive, False).result()
+        return hash_probe(file_path, result, self._fast_hash)
+
+    def _write_next(self, pending):
+        # Single writer: results are consumed in walk order, committing per directory or per bulk batch
+        kind, root, item, future = pending.popleft()
+        if self._session is None:
+            self._session = Session(get_engine(), autoflush=False)
+        if kind in ("file", "ignored"):
+            file, st = item
+            result = self._probe_result(root, file, st, future)
+            if result is None:
+                return
+            media_info, md5, fingerprint, reason, raw = result
+            start = time.perf_counter()
+            self._release(root, file)
+            ignored_file = None
+            if kind == "ignored":
+                ignored_file = self._session.scalars(select(IgnoredFile).where(IgnoredFile.path==root, IgnoredFile.name==file)).one()
+            if media_info is not None:
+                logger.debug("File %s in directory %s does not exist in DB, scanning", file, root)
+                if self._bulk is not None:
+                    self._bulk.add_file(file, root, md5, st, media_info, fingerprint, raw)
+                else:
+                    lf = LibraryFile(file,root,md5,st,fingerprint)
+                    lf.parse_tracks(media_info)
+                    self._session.add(lf)
+                    if raw is not None:
+                        self._session.add(RawMediaInfo(lf.id, st, raw))
+                if ignored_file is not None:
+                    self._session.delete(ignored_file)
+                self.stats.count("files_added")
+            elif ignored_file is not None:
+                ignored_file.set_stat(st)
+                ignored_file.reason = reason
+                self.stats.count("files_ignored")
+            else:
+                logger.debug("File %s in directory %s is not a media file (%s)", file, root, reason)
+                if self._bulk is not None:
+                    self._bulk.add_ignored(file, root, st, reason)
+                else:
+                    self._session.add(IgnoredFile(file,root,st,reason))
+                self.stats.count("files_ignored")
+            self.stats.add_time("orm", time.perf_counter() - start)
+            self._file_written()
+            return
+        if kind == "update":
+            file, st = item
+            result = self._probe_result(root, file, st, future)
+            if result is None:
+                # The stored signature stays old, the quarantine entry holds the new one
+                return
+            media_info, md5, fingerprint, reason, raw = result
+            start = time.perf_counter()
+            self._release(root, file)
+            lf = self._session.scalars(select(LibraryFile).where(LibraryFile.path==root, LibraryFile.name==file)).one()
+            lf.set_stat(st)
+            lf.missing_on_disk = None
+            # Hashes of the old content would go with the new signature; one the probe did
+            # not compute stays NULL, so BackgroundHasher fills it in
+            lf.md5 = md5
+            lf.fingerprint = fingerprint
+            if media_info is None:
+                logger.warning("File %s in directory %s is no longer recognized as media, keeping existing tracks", file, root)
+            else:
+                lf.parse_tracks(media_info)
+                if raw is not None:
+                    archived = self._session.get(RawMediaInfo, lf.id)
+                    if archived is None:
+                        self._session.add(RawMediaInfo(lf.id, st, raw))
                     else:
-                        media_info = MediaInfo.parse(os.path.join(root,file))
-                        if len(media_info.tracks)>1:
-                            logger.debug("File %s in directory %s does not exist in DB, scanning", file, root)
-                            lf = LibraryFile(file,root)
-                            lf.parse_tracks(media_info)
-                            session.add(lf)
-                if len(existing_filenames)>1:
-                    logger.info("Files in DB that were not found on disk: %s", existing_filenames)
-                    missing_files = session.execute(select(LibraryFile).where(LibraryFile.name.in_(existing_filenames))).all()
-                    for missing_file in missing_files:
-                        missing_file[0].missing_on_disk=1
-                session.flush()
-                session.commit()
\ No newline at end of file
+                        archived.update(st, raw)
+            self.stats.add_time("orm", time.perf_counter() - start)
+            self.stats.count("files_updated")
+            self._file_written()
+            return
+        if kind == "move":
+            file, st, moved_id = item
+            lf = self._session.get(LibraryFile, moved_id)
+            lf.move_to(file, root)
+            lf.set_stat(st)
+            lf.missing_on_disk = None
+            archived = self._session.get(RawMediaInfo, moved_id)
+            if archived is not None:
+                # Same content, so the archived output is still valid for the new stat signature
+                archived.set_stat(st)
+            self.stats.count("files_moved")
+            self._file_written()
+            return
+        if kind == "stat":
+            file, st = item
+            lf = self._session.scalars(select(LibraryFile).where(LibraryFile.path==root, LibraryFile.name==file)).one()
+            lf.set_stat(st)
+            return
+
+        directory_id, values = item
+        if root in self._read_errors:
+            # Values that never match, so the next scan lists the directory and retries its files
+            values = dict(values or {}, mtime_ns=-1, files_signature="")
+        if values is not None:
+            if directory_id is None:
+                self._session.add(DirectoryIndex(**values))
+            else:
+                self._session.get(DirectoryIndex, directory_id).update(**values)
+        if self._bulk is None or self._commit_policy.due():
+            self._commit()
+
+    def _probe_result(self, root, file, st, future):
+        # None when the probe failed. A file that could not be read (permissions, I/O
+        # errors) is retried by the next scan, one that failed to parse is quarantined.
+        start = time.perf_counter()
+        try:
+            result = future.result()
+        except OSError as e:
+            self.stats.add_time("wait", time.perf_counter() - start)
+            self._read_error(root, file, e)
+            return None
+        except Exception as e:
+            self.stats.add_time("wait", time.perf_counter() - start)
+            self._consecutive_read_errors = 0
+            self._quarantine(root, file, st, str(e) if isinstance(e, ParseFailed) else "%s: %s" % (type(e).__name__, e))
+            return None
+        self.stats.add_time("wait", time.perf_counter() - start)
+        self._consecutive_read_errors = 0
+        self.stats.record_probe(os.path.join(root, file), result.timings)
+        return result.media_info, result.md5, result.fingerprint, result.reason, result.raw
+
+    def _read_error(self, root, file, error):
+        file_path = os.path.join(root, file)
+        if not os.path.lexists(file_path):
+            logger.info("File %s disappeared before it could be parsed", file_path)
+            return
+        self._read_errors.add(root)
+        self._consecutive_read_errors += 1
+        self.stats.count("files_unreadable")
+        if self._consecutive_read_errors >= MAX_CONSECUTIVE_READ_ERRORS:
+            raise RuntimeError("Aborting the scan after %d files in a row could not be read, last %s: %s"
+                               % (self._consecutive_read_errors, file_path, error))
+        logger.warning("Could not read %s, retrying it on the next scan: %s", file_path, error)
+
+    def _quarantine(self, root, file, st, error):
+        file_path = os.path.join(root, file)
+        if not os.path.lexists(file_path):
+            logger.info("File %s disappeared before it could be parsed", file_path)
+            return
+        self._retrying.discard((root, file))
+        quarantined = self._session.scalars(select(QuarantinedFile).where(QuarantinedFile.path==root,
+                                                                          QuarantinedFile.name==file)).one_or_none()
+        if quarantined is None:
+            quarantined = QuarantinedFile(file, root, st, error)
+            self._session.add(quarantined)
+        else:
+            quarantined.failed(st, error)
+        logger.warning("Could not parse %s (attempt %d), skipping it until it changes: %s", file_path, quarantined.attempts, error)
+        self.stats.count("files_failed")
+        self._file_written()
+
+    def _release(self, root, file):
+        if (root, file) not in self._retrying:
+            return
+        self._retrying.discard((root, file))
+        quarantined = self._session.scalars(select(QuarantinedFile).where(QuarantinedFile.path==root,
+                                                                          QuarantinedFile.name==file)).one_or_none()
+        if quarantined is not None:
+            logger.info("File %s in directory %s parsed after %d failed attempts", file, root, quarantined.attempts)
+            self._session.delete(quarantined)
+
+    def _file_written(self):
+        # Bulk mode commits on its file/time budget, also in the middle of a large directory
+        self._commit_policy.add()
+        if self._bulk is not None and self._commit_policy.due():
+            self._commit()
+
+    def _commit(self):
+        if self._session is None:
+            return
+        self._check_stop()
+        with self.stats.timer("flush"):
+            # Only transactions that change File rows take a new generation
+            files = [obj for obj in chain(self._session.new, self._session.dirty) if isinstance(obj, LibraryFile)]
+            generation = None
+            if files or (self._bulk is not None and self._bulk.pending_files):
+                generation = CatalogGeneration.bump(self._session)
+                for library_file in files:
+                    library_file.generation = generation
+            if self._bulk is not None:
+                self._bulk.flush(self._session, generation)
+            self._session.flush()
+        with self.stats.timer("commit"):
+            self._session.commit()
+        self._session.close()
+        self._session = None
+        self._commit_policy.reset()
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Scan a directory tree into the media library")
+    parser.add_argument("root_dir")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of parse/hash workers (1 scans serially)")
+    parser.add_argument("--processes", action="store_true",
+                        help="use worker processes instead of threads")
+    parser.add_argument("--ignored-extensions", default=",".join(sorted(IGNORED_EXTENSIONS)),
+                        help="comma separated extensions that are never parsed (.DS_Store, Thumbs.db and "
+                             "desktop.ini files never are either)")
+    parser.add_argument("--no-signature-filter", action="store_true",
+                        help="hand every file to libmediainfo regardless of its leading bytes")
+    parser.add_argument("--bulk", action="store_true",
+                        help="insert new rows in batches instead of through the ORM unit of work")
+    parser.add_argument("--commit-files", type=int, default=1000,
+                        help="in bulk mode, commit after this many files")
+    parser.add_argument("--commit-seconds", type=float, default=30.0,
+                        help="in bulk mode, commit at least this often")
+    parser.add_argument("--fast-hash", action="store_true",
+                        help="store a sampled fingerprint and leave the full md5 to BackgroundHasher.py")
+    parser.add_argument("--single-pass", action="store_true",
+                        help="open each file once and hash the bytes libmediainfo reads, parsing without "
+                             "the --parse-timeout budget")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip listing directories whose mtime is unchanged since the last scan")
+    parser.add_argument("--no-archive", action="store_true",
+                        help="do not keep the compressed MediaInfo output used by MediaInfoArchive.py")
+    parser.add_argument("--parse-timeout", type=float,
+                        help="seconds libmediainfo may take to parse a file before its worker process is killed "
+                             "and the file quarantined (hashing is not limited), 0 parses in threads (or --processes) "
+                             "without a budget (default 300, 0 with --single-pass)")
+    parser.add_argument("--retry-quarantined", type=int, nargs="?", const=-1, metavar="MAX_ATTEMPTS",
+                        help="parse quarantined files again, only those that failed at most MAX_ATTEMPTS times if given")
+    parser.add_argument("--no-aggregates", action="store_true",
+                        help="do not rebuild the aggregates served by QueryService.py after the scan")
+    parser.add_argument("--progress-interval", type=float, default=30.0,
+                        help="seconds between progress lines, 0 disables them")
+    parser.add_argument("--stats-json", help="write stage timings and counters to this JSON file")
+    parser.add_argument("--stats-prometheus", help="write stage timings and counters to this file "
+                                                   "in Prometheus text format (for node_exporter's textfile collector)")
+    parser.add_argument("--profile", help="run the scan under cProfile and write the pstats dump to this file")
+    args = parser.parse_args()
+    if args.parse_timeout is None:
+        args.parse_timeout = 0.0 if args.single_pass else 300.0
+    elif args.single_pass and args.parse_timeout:
+        parser.error("--single-pass parses without a time budget, it cannot be combined with --parse-timeout")
+    scanner = FileScanner(args.root_dir, args.workers, args.processes,
+                          ignored_extensions=[ext for ext in args.ignored_extensions.split(",") if ext],
+                          non_media_signatures=() if args.no_signature_filter else NON_MEDIA_SIGNATURES,
+                          bulk=args.bulk, commit_files=args.commit_files, commit_seconds=args.commit_seconds,
+                          fast_hash=args.fast_hash, single_pass=args.single_pass, quick=args.quick,
+                          progress_interval=args.progress_interval, archive=not args.no_archive,
+                          parse_timeout=args.parse_timeout or None, aggregates=not args.no_aggregates)
+    if args.retry_quarantined is not None:
+        ensure_schema()
+        max_attempts = args.retry_quarantined if args.retry_quarantined >= 0 else None
+        released = release_quarantined(os.path.abspath(os.path.expanduser(os.path.expandvars(args.root_dir))),
+                                       max_attempts=max_attempts)
+        logger.info("Released %d quarantined files", released)
+    with profiled(args.profile):
+        scanner.scan()
+    if args.stats_json:
+        scanner.stats.write_json(args.stats_json)
+    if args.stats_prometheus:
+        scanner.stats.write_prometheus(args.stats_prometheus)
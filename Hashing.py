@@ -0,0 +1,90 @@
+import os
+import hashlib
+
+HASH_CHUNK_SIZE = 65536
+# Bytes read from the start and from the end of a file for a partial hash
+PARTIAL_BLOCK_SIZE = 65536
+# Evenly spaced blocks sampled for a quick fingerprint
+FINGERPRINT_SAMPLES = 8
+
+def md5_file(file_path, throttle=None):
+    # throttle, if given, is called with the size of every chunk read
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+            md5.update(data)
+            if throttle is not None:
+                throttle(len(data))
+    return md5.hexdigest()
+
+def fingerprint_file(file_path, samples=FINGERPRINT_SAMPLES, block_size=PARTIAL_BLOCK_SIZE):
+    # Quick identity for ingest: the file size plus sampled blocks, including head and tail
+    h = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(str(size).encode())
+        if size <= samples * block_size:
+            h.update(f.read())
+        else:
+            for i in range(samples):
+                f.seek((size - block_size) * i // (samples - 1))
+                h.update(f.read(block_size))
+    return h.hexdigest()
+
+def partial_hash(file_path, block_size=PARTIAL_BLOCK_SIZE):
+    # Cheap pre-filter for duplicate detection: hashes only the head and tail blocks
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(block_size, size - block_size))
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+def files_signature(entries):
+    # Digest of (name, stat_result) pairs, independent of listing order
+    h = hashlib.blake2b(digest_size=16)
+    for name, st in sorted(entries, key=lambda entry: entry[0]):
+        h.update(name.encode('utf-8', 'surrogateescape'))
+        h.update(b"\0%d\0%d\0%d\0%d\n" % (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev))
+    return h.hexdigest()
+
+class HashingReader:
+    # Read-only file wrapper that hashes bytes as a consumer (e.g. libmediainfo)
+    # reads them. Only the contiguous prefix can be hashed in order; finish()
+    # reads whatever the consumer skipped and returns the digest of the whole file.
+    def __init__(self, f, hasher=None):
+        self._f = f
+        self._hasher = hasher if hasher is not None else hashlib.md5()
+        self.name = getattr(f, "name", None)
+        self.mode = "rb"
+        self.hashed_until = 0
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        pos = self._f.tell()
+        data = self._f.read(size)
+        end = pos + len(data)
+        if pos <= self.hashed_until < end:
+            self._hasher.update(memoryview(data)[self.hashed_until - pos:])
+            self.hashed_until = end
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def finish(self):
+        self._f.seek(self.hashed_until)
+        while True:
+            data = self.read(HASH_CHUNK_SIZE)
+            if not data:
+                break
+        return self._hasher.hexdigest()
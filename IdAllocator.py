@@ -0,0 +1,68 @@
+import time
+import threading
+from sqlalchemy import select, func
+
+class BlockIdAllocator:
+    # Hands out ids from blocks reserved in the database. Blocks are reserved
+    # atomically so several scanner processes never receive overlapping ids, and
+    # the block size doubles while ids are being consumed quickly.
+    GROW_INTERVAL = 1.0
+    IDLE_INTERVAL = 60.0
+
+    def __init__(self, block_size=100, max_block_size=100000):
+        self._lock = threading.Lock()
+        self.min_block_size = block_size
+        self.max_block_size = max(block_size, max_block_size)
+        self.block_size = block_size
+        self._blocks = []
+        self.current_value = 0
+        self.max_id_value = 0
+        self._last_fill = None
+
+    def _reserve(self, count):
+        # Returns a list of (start, end) ranges covering at least count ids
+        raise NotImplementedError
+
+    def fill_pool(self):
+        now = time.monotonic()
+        if self._last_fill is not None:
+            elapsed = now - self._last_fill
+            if elapsed < self.GROW_INTERVAL:
+                self.block_size = min(self.block_size * 2, self.max_block_size)
+            elif elapsed > self.IDLE_INTERVAL:
+                self.block_size = self.min_block_size
+        self._last_fill = now
+        self._blocks.extend(self._reserve(self.block_size))
+        self.current_value, self.max_id_value = self._blocks.pop(0)
+
+    def next_value(self):
+        with self._lock:
+            if self.current_value >= self.max_id_value:
+                if self._blocks:
+                    self.current_value, self.max_id_value = self._blocks.pop(0)
+                else:
+                    self.fill_pool()
+            nextval = self.current_value
+            self.current_value += 1
+            return nextval
+
+class SequenceIdAllocator(BlockIdAllocator):
+    # hi/lo allocation on top of a database sequence: every nextval() owns the
+    # following `increment` ids. On PostgreSQL several blocks are fetched in one
+    # round trip, elsewhere with one statement per block in a single transaction.
+    def __init__(self, sequence, engine, block_size=None, max_block_size=100000):
+        self.increment = sequence.increment or 1
+        block_size = -(-(block_size or self.increment) // self.increment) * self.increment
+        super().__init__(block_size, max_block_size)
+        self.sequence = sequence
+        self.engine = engine
+
+    def _reserve(self, count):
+        blocks = -(-count // self.increment)
+        with self.engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                values = connection.scalars(select(self.sequence.next_value())
+                                            .select_from(func.generate_series(1, blocks))).all()
+            else:
+                values = [connection.scalar(select(self.sequence.next_value())) for _ in range(blocks)]
+        return [(value, value + self.increment) for value in sorted(values)]
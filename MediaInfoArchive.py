@@ -0,0 +1,184 @@
+import os
+import zlib
+import argparse
+import logging
+import logging.config
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pymediainfo import MediaInfo
+from sqlalchemy import select, update, delete, insert
+from sqlalchemy.orm import Session
+
+from Tracks import LibraryFile, GeneralTrack, VideoTrack, AudioTrack, ImageTrack, FileSummary
+from ScanObjects import RawMediaInfo, CatalogGeneration
+from Base import Base, get_engine
+from Migrations import ensure_schema
+from Reconcile import under_path
+
+logger = logging.getLogger('MediaInfoArchive')
+
+# MediaInfo XML is very repetitive, level 6 already gets most of what zlib can do
+COMPRESSION_LEVEL = 6
+# Tables that can be rebuilt from the archive
+PROJECTED_CLASSES = {track_class.__table__: track_class
+                     for track_class in (GeneralTrack, VideoTrack, AudioTrack, ImageTrack, FileSummary)}
+PROJECTED_TABLES = {table.name: table for table in PROJECTED_CLASSES}
+MODES = ("update", "rebuild", "backfill")
+
+def compress_xml(xml):
+    return zlib.compress(xml.encode("utf-8"), COMPRESSION_LEVEL)
+
+def decompress_xml(data, compression="zlib"):
+    if compression != "zlib":
+        raise ValueError("Unknown MediaInfo archive compression: %s" % compression)
+    return zlib.decompress(data).decode("utf-8")
+
+def fill_path_fields(media_info, file_path, overwrite=False):
+    # libmediainfo does not know the file name when fed from a buffer, and archived
+    # output still names the old location of files that were moved since
+    folder_name, base_name = os.path.split(file_path)
+    file_name, file_extension = os.path.splitext(base_name)
+    for track in media_info.general_tracks:
+        if overwrite or track.file_name is None:
+            track.file_name = file_name
+        if overwrite or track.file_extension is None:
+            track.file_extension = file_extension[1:]
+        if overwrite or track.folder_name is None:
+            track.folder_name = folder_name
+        if overwrite or track.complete_name is None:
+            track.complete_name = file_path
+
+def load_archived(compression, data, file_path):
+    media_info = MediaInfo(decompress_xml(data, compression))
+    fill_path_fields(media_info, file_path, overwrite=True)
+    return media_info
+
+def projected_rows(file_key, media_info, tables):
+    # The rows ingest would write for media_info (tracks and the file summary), limited to tables
+    yield from LibraryFile.track_rows(file_key, media_info, tables)
+    if FileSummary.__table__ in tables:
+        yield FileSummary.__table__, FileSummary.row(file_key, media_info)
+
+class Reprojector:
+    # Rebuilds track and summary rows from archived MediaInfo output in bulk, for files
+    # whose archive still matches their stat signature. "update" rewrites the existing
+    # rows in place, keeping their ids, e.g. to fill a newly added column; "rebuild"
+    # deletes and inserts them again under new ids; "backfill" only adds rows to files
+    # that have none in a table, e.g. after a new track table was introduced.
+    def __init__(self, tables=None, mode="update", path_prefix=None, batch_size=500, workers=1):
+        if mode not in MODES:
+            raise ValueError("Unknown re-projection mode: %s" % mode)
+        self._tables = [PROJECTED_TABLES[name] for name in (tables or PROJECTED_TABLES)]
+        self._mode = mode
+        self._path_prefix = path_prefix
+        self._batch_size = batch_size
+        self._workers = max(1, workers)
+        self.stats = defaultdict(int)
+
+    def _batches(self, session):
+        stmt = select(LibraryFile.id, LibraryFile.path, LibraryFile.name, RawMediaInfo.compression, RawMediaInfo.data) \
+            .join(RawMediaInfo, RawMediaInfo.file_key==LibraryFile.id) \
+            .where(RawMediaInfo.size==LibraryFile.size, RawMediaInfo.mtime_ns==LibraryFile.mtime_ns)
+        if self._path_prefix is not None:
+            stmt = stmt.where(under_path(LibraryFile.path, self._path_prefix))
+        last_id = 0
+        while True:
+            rows = session.execute(stmt.where(LibraryFile.id>last_id).order_by(LibraryFile.id).limit(self._batch_size)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            yield rows
+
+    def _existing_rows(self, session, table, file_keys):
+        # Keys of the rows each file has in table, in id order
+        key = table.c.id if "id" in table.c else table.c.file_key
+        existing = defaultdict(list)
+        for row_key, file_key in session.execute(select(key, table.c.file_key)
+                                                 .where(table.c.file_key.in_(file_keys)).order_by(key)):
+            existing[file_key].append(row_key)
+        return existing
+
+    def _match(self, table, keys, new_rows, inserts, updates, deletes):
+        # Existing rows take the new values in order, as LibraryFile.parse_tracks does
+        # on a rescan; surplus rows on either side are inserted or deleted
+        for key, table_row in zip(keys, new_rows):
+            if "id" in table_row:
+                table_row["id"] = key
+            updates[table].append(table_row)
+        inserts[table].extend(new_rows[len(keys):])
+        deletes[table].extend(keys[len(new_rows):])
+
+    def run(self):
+        ensure_schema()
+        pool = ProcessPoolExecutor(max_workers=self._workers) if self._workers > 1 else None
+        run = pool.map if pool is not None else map
+        try:
+            with Session(get_engine()) as session:
+                for rows in self._batches(session):
+                    file_keys = [row.id for row in rows]
+                    existing = {}
+                    if self._mode != "rebuild":
+                        existing = {table: self._existing_rows(session, table, file_keys) for table in self._tables}
+                    # Ends the read transaction before ids are reserved on another connection
+                    session.commit()
+                    media_infos = run(load_archived, [row.compression for row in rows], [row.data for row in rows],
+                                      [os.path.join(row.path, row.name) for row in rows])
+                    inserts = defaultdict(list)
+                    updates = defaultdict(list)
+                    deletes = defaultdict(list)
+                    for row, media_info in zip(rows, media_infos):
+                        projected = defaultdict(list)
+                        for table, table_row in projected_rows(row.id, media_info, self._tables):
+                            projected[table].append(table_row)
+                        for table in self._tables:
+                            if self._mode == "update":
+                                self._match(table, existing[table].get(row.id, []), projected[table],
+                                            inserts, updates, deletes)
+                            elif self._mode == "rebuild" or row.id not in existing[table]:
+                                inserts[table].extend(projected[table])
+                    changed = {table_row["file_key"] for rows_of_table in inserts.values() for table_row in rows_of_table} \
+                        if self._mode == "backfill" else set(file_keys)
+                    if changed:
+                        session.execute(update(LibraryFile).where(LibraryFile.id.in_(changed))
+                                        .values(generation=CatalogGeneration.bump(session)))
+                    if self._mode == "rebuild":
+                        for table in self._tables:
+                            session.execute(delete(table).where(table.c.file_key.in_(file_keys)))
+                    for table, keys in deletes.items():
+                        if keys:
+                            key = table.c.id if "id" in table.c else table.c.file_key
+                            session.execute(delete(table).where(key.in_(keys)))
+                    for table, table_rows in updates.items():
+                        if table_rows:
+                            # Bulk UPDATE by primary key
+                            session.execute(update(PROJECTED_CLASSES[table]), table_rows)
+                            self.stats[table.name] += len(table_rows)
+                    for table in Base.metadata.sorted_tables:
+                        if inserts.get(table):
+                            session.execute(insert(table), inserts[table])
+                            self.stats[table.name] += len(inserts[table])
+                    session.commit()
+                    self.stats["files"] += len(rows)
+                    logger.info("Re-projected %d files", self.stats["files"])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        logger.info("Re-projection done: %s", dict(self.stats))
+        return self.stats
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Rebuild track tables from archived MediaInfo output instead of re-parsing files")
+    parser.add_argument("--mode", choices=MODES, default="update",
+                        help="update rewrites existing rows in place (e.g. to fill a new column), rebuild deletes "
+                             "and re-inserts them under new ids, backfill only adds rows to files that have none "
+                             "in a table (e.g. a new track table)")
+    parser.add_argument("--table", action="append", choices=sorted(PROJECTED_TABLES),
+                        help="table to re-project, may be repeated (default: all)")
+    parser.add_argument("--path", help="only re-project files below this directory")
+    parser.add_argument("--batch-size", type=int, default=500, help="files per transaction")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="processes decoding archived output")
+    args = parser.parse_args()
+    path_prefix = os.path.abspath(os.path.expanduser(args.path)) if args.path else None
+    Reprojector(args.table, args.mode, path_prefix, args.batch_size, args.workers).run()
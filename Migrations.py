@@ -0,0 +1,209 @@
+import os
+import argparse
+import logging
+import logging.config
+import threading
+from datetime import datetime
+from sqlalchemy import Integer, String, DateTime, MetaData, inspect, select, insert, text
+from sqlalchemy.orm import Mapped, mapped_column, Session, defer
+
+from Base import Base, get_engine, engine_type, uses_id_table
+from Tracks import LibraryFile, GeneralTrack, VideoTrack, AudioTrack, ImageTrack, FileSummary
+from ScanObjects import IgnoredFile, DirectoryIndex, HashProgress, RawMediaInfo, QuarantinedFile, ScanWorkUnit, CatalogGeneration, CatalogAggregate
+from SqliteObjects import IdSequenceTable
+from Queries import track_loaders
+
+logger = logging.getLogger('Migrations')
+
+# Files summarized per batch when FileSummary is filled from existing track rows
+SUMMARY_BATCH_SIZE = 1000
+
+class SchemaVersion(Base):
+    # One row per applied migration
+    __tablename__ = "SchemaVersion"
+    version: Mapped[int] = mapped_column(Integer,primary_key=True)
+    description: Mapped[str] = mapped_column(String(200))
+    applied: Mapped[datetime] = mapped_column(DateTime)
+
+def _add_columns(connection, table, column_names):
+    # Adds columns of the mapped table that an older schema lacks
+    existing = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    preparer = connection.dialect.identifier_preparer
+    for name in column_names:
+        if name not in existing:
+            column = table.c[name]
+            connection.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (preparer.format_table(table), preparer.format_column(column),
+                                                                         column.type.compile(dialect=connection.dialect))))
+
+def _create_indexes(connection, table, index_names):
+    for index in table.indexes:
+        if index.name in index_names:
+            index.create(connection, checkfirst=True)
+
+def _drop_not_null(connection, table, column_name):
+    column = table.c[column_name]
+    preparer = connection.dialect.identifier_preparer
+    if connection.dialect.name == "sqlite":
+        _rebuild_sqlite_table(connection, table)
+    elif connection.dialect.name in ("mysql", "mariadb"):
+        connection.execute(text("ALTER TABLE %s MODIFY %s %s NULL" % (preparer.format_table(table), preparer.format_column(column),
+                                                                      column.type.compile(dialect=connection.dialect))))
+    else:
+        connection.execute(text("ALTER TABLE %s ALTER COLUMN %s DROP NOT NULL" % (preparer.format_table(table),
+                                                                                 preparer.format_column(column))))
+
+def _rebuild_sqlite_table(connection, table):
+    # SQLite cannot alter a column in place. The new table is built under a temporary
+    # name and renamed afterwards: renaming the old table away would also rewrite the
+    # foreign keys of the track tables to point at it.
+    existing = [column["name"] for column in inspect(connection).get_columns(table.name)]
+    for index in inspect(connection).get_indexes(table.name):
+        connection.execute(text("DROP INDEX %s" % connection.dialect.identifier_preparer.quote(index["name"])))
+    new_table = table.to_metadata(MetaData(), name=table.name + "_new")
+    new_table.indexes.clear()
+    new_table.create(connection)
+    columns = ", ".join(connection.dialect.identifier_preparer.quote(name) for name in existing if name in table.c)
+    connection.execute(text('INSERT INTO "%s" (%s) SELECT %s FROM "%s"' % (new_table.name, columns, columns, table.name)))
+    connection.execute(text('DROP TABLE "%s"' % table.name))
+    connection.execute(text('ALTER TABLE "%s" RENAME TO "%s"' % (new_table.name, table.name)))
+    for index in table.indexes:
+        index.create(connection)
+
+def _stat_columns(connection):
+    file_table = LibraryFile.__table__
+    _add_columns(connection, file_table, ["size", "mtime_ns", "inode", "device"])
+    _create_indexes(connection, file_table, ["ix_File_size"])
+
+def _fingerprints(connection):
+    file_table = LibraryFile.__table__
+    _add_columns(connection, file_table, ["fingerprint"])
+    if not next(column for column in inspect(connection).get_columns("File") if column["name"] == "md5")["nullable"]:
+        _drop_not_null(connection, file_table, "md5")
+    _create_indexes(connection, file_table, ["ix_File_md5", "ix_File_fingerprint"])
+
+def _scan_tables(connection):
+    for table in (IgnoredFile, DirectoryIndex, HashProgress):
+        table.__table__.create(connection, checkfirst=True)
+
+def _file_summaries(connection):
+    for track_class in (GeneralTrack, VideoTrack, AudioTrack, ImageTrack):
+        _create_indexes(connection, track_class.__table__, ["ix_%s_file_key" % track_class.__tablename__])
+    FileSummary.__table__.create(connection, checkfirst=True)
+    # Track rows carry the attributes FileSummary reads from MediaInfo, so no file is re-parsed.
+    # File columns added by later migrations do not exist yet and are not loaded.
+    existing = {column["name"] for column in inspect(connection).get_columns(LibraryFile.__tablename__)}
+    not_yet_added = [defer(getattr(LibraryFile, column.key), raiseload=True) for column in LibraryFile.__table__.columns
+                     if column.name not in existing]
+    session = Session(connection)
+    last_id = 0
+    summarized = 0
+    while True:
+        files = session.scalars(select(LibraryFile).where(LibraryFile.id>last_id, ~LibraryFile.summary.has())
+                                .options(*track_loaders(), *not_yet_added)
+                                .order_by(LibraryFile.id).limit(SUMMARY_BATCH_SIZE)).all()
+        if not files:
+            break
+        connection.execute(insert(FileSummary.__table__), [FileSummary.row(library_file.id, library_file) for library_file in files])
+        summarized += len(files)
+        last_id = files[-1].id
+        session.expunge_all()
+    session.close()
+    logger.info("Summarized %d existing files", summarized)
+
+def _mediainfo_archive(connection):
+    RawMediaInfo.__table__.create(connection, checkfirst=True)
+
+def _quarantine(connection):
+    QuarantinedFile.__table__.create(connection, checkfirst=True)
+
+def _work_queue(connection):
+    ScanWorkUnit.__table__.create(connection, checkfirst=True)
+
+def _generations(connection):
+    file_table = LibraryFile.__table__
+    _add_columns(connection, file_table, ["generation"])
+    _create_indexes(connection, file_table, ["ix_File_generation"])
+    CatalogGeneration.__table__.create(connection, checkfirst=True)
+
+def _aggregates(connection):
+    CatalogAggregate.__table__.create(connection, checkfirst=True)
+
+# (version, description, step) in the order they are applied. A new database gets the
+# current schema from create_all and is stamped with every version; databases created
+# before migrations existed (no SchemaVersion table) start at version 0.
+MIGRATIONS = [
+    (1, "File stat signature columns", _stat_columns),
+    (2, "File fingerprint column, optional md5", _fingerprints),
+    (3, "Negative cache, directory index and hash progress tables", _scan_tables),
+    (4, "Track file_key indexes and file summary table", _file_summaries),
+    (5, "Raw MediaInfo archive", _mediainfo_archive),
+    (6, "Quarantine for files that fail to parse", _quarantine),
+    (7, "Work queue for sharded scans", _work_queue),
+    (8, "Catalog generation counter and File generation column", _generations),
+    (9, "Precomputed catalog aggregates", _aggregates),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_checked = set()
+_lock = threading.Lock()
+
+def _schema_tables(connection):
+    # Id_Sequence only backs ids on SQLite and backends without sequences, others use ID_SEQUENCE
+    return [table for table in Base.metadata.sorted_tables
+            if table is not IdSequenceTable.__table__ or uses_id_table(connection.dialect)]
+
+def current_version(connection):
+    tables = inspect(connection).get_table_names()
+    if SchemaVersion.__tablename__ in tables:
+        return connection.scalar(select(SchemaVersion.version).order_by(SchemaVersion.version.desc()).limit(1)) or 0
+    if LibraryFile.__tablename__ in tables:
+        return 0
+    return None
+
+def migrate(engine=None):
+    # Brings the schema up to SCHEMA_VERSION, returns the versions applied
+    engine = engine if engine is not None else get_engine()
+    applied = []
+    with engine.begin() as connection:
+        version = current_version(connection)
+        if version is None:
+            logger.info("Creating schema version %d", SCHEMA_VERSION)
+            Base.metadata.create_all(connection, tables=_schema_tables(connection))
+            pending = MIGRATIONS
+        else:
+            SchemaVersion.__table__.create(connection, checkfirst=True)
+            pending = [migration for migration in MIGRATIONS if migration[0] > version]
+            for number, description, step in pending:
+                logger.info("Applying migration %d: %s", number, description)
+                step(connection)
+            # Tables added without a migration step of their own
+            Base.metadata.create_all(connection, tables=_schema_tables(connection))
+        for number, description, step in pending:
+            connection.execute(SchemaVersion.__table__.insert().values(version=number, description=description,
+                                                                         applied=datetime.now()))
+            applied.append(number)
+    return applied
+
+def ensure_schema(engine=None):
+    # Cheap to call at the start of every writing command: checked once per engine and process
+    engine = engine if engine is not None else get_engine()
+    if engine in _checked:
+        return
+    with _lock:
+        if engine not in _checked:
+            migrate(engine)
+            _checked.add(engine)
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Create or upgrade the media library schema")
+    parser.add_argument("--status", action="store_true", help="only print the schema version")
+    args = parser.parse_args()
+    if args.status:
+        with get_engine().connect() as connection:
+            version = current_version(connection)
+        print("%s: schema version %s, current %d" % (engine_type(), "none" if version is None else version, SCHEMA_VERSION))
+    else:
+        applied = migrate()
+        print("Applied migrations: %s" % (", ".join(map(str, applied)) or "none"))
@@ -0,0 +1,143 @@
+import queue
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import Future
+
+class ParseTimeout(Exception):
+    pass
+
+class WorkerCrashed(Exception):
+    pass
+
+class ParseFailed(Exception):
+    # An exception raised inside a worker process, carried back as text
+    pass
+
+def _worker_main(connection):
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            result = (True, fn(*args))
+        except OSError as e:
+            # Raised again as OSError in the parent: the file could not be read, it did not fail to parse
+            result = (False, "%s: %s" % (type(e).__name__, e), traceback.format_exc(), (e.errno, e.strerror, e.filename))
+        except BaseException as e:
+            result = (False, "%s: %s" % (type(e).__name__, e), traceback.format_exc(), None)
+        try:
+            connection.send(result)
+        except Exception as e:
+            # The result could not be pickled
+            connection.send((False, "%s: %s" % (type(e).__name__, e), traceback.format_exc(), None))
+
+class IsolatedPool:
+    # Executor-like pool where every task runs in a worker process under a time budget.
+    # Each worker is driven by its own supervisor thread: a worker that exceeds the
+    # budget is killed, one that dies (e.g. libmediainfo crashing) is noticed through
+    # its closed pipe, and either way the task fails and a fresh worker takes over.
+    def __init__(self, workers=1, timeout=300.0, max_tasks_per_worker=None):
+        self._timeout = timeout
+        self._max_tasks = max_tasks_per_worker
+        # Workers start from a fresh interpreter rather than a fork of the scanner, whose
+        # threads may hold locks (logging, the engine's pool) at that moment. Tasks are
+        # therefore pickled by reference and must be importable module level functions.
+        self._context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                                                    else "spawn")
+        self._tasks = queue.SimpleQueue()
+        self._threads = [threading.Thread(target=self._supervise, name="ParseSupervisor-%d" % i, daemon=True)
+                         for i in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._tasks.put((future, fn, args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        if cancel_futures:
+            while True:
+                try:
+                    task = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[0].cancel()
+        for _ in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _start_worker(self):
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_connection,), name="ParseWorker", daemon=True)
+        process.start()
+        child_connection.close()
+        return process, parent_connection
+
+    def _stop_worker(self, process, connection, kill=False):
+        if kill:
+            process.kill()
+        else:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        connection.close()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _supervise(self):
+        process = connection = None
+        tasks_done = 0
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                future, fn, args = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if process is not None and self._max_tasks and tasks_done >= self._max_tasks:
+                    self._stop_worker(process, connection)
+                    process = None
+                if process is None:
+                    try:
+                        process, connection = self._start_worker()
+                    except Exception as e:
+                        future.set_exception(WorkerCrashed("could not start a parse worker: %s" % e))
+                        continue
+                    tasks_done = 0
+                tasks_done += 1
+                try:
+                    connection.send((fn, args))
+                    ready = connection.poll(self._timeout)
+                    result = connection.recv() if ready else None
+                except (EOFError, OSError):
+                    process.join(5)
+                    future.set_exception(WorkerCrashed("parse worker died (exit code %s)" % process.exitcode))
+                    self._stop_worker(process, connection, kill=True)
+                    process = None
+                    continue
+                if result is None:
+                    future.set_exception(ParseTimeout("no result after %.0f seconds, worker killed" % self._timeout))
+                    self._stop_worker(process, connection, kill=True)
+                    process = None
+                elif result[0]:
+                    future.set_result(result[1])
+                elif result[3] is not None:
+                    future.set_exception(OSError(*result[3]) if result[3][0] is not None else OSError(result[1]))
+                else:
+                    future.set_exception(ParseFailed(result[1]))
+        finally:
+            if process is not None:
+                self._stop_worker(process, connection)
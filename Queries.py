@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import argparse
+from sqlalchemy import select, func, or_
+from sqlalchemy.orm import Session, selectinload
+
+from Tracks import LibraryFile, FileSummary
+from Base import get_engine
+from Reconcile import under_path
+
+# Read side of the catalog. Files are loaded with their tracks in one SELECT per
+# relationship for the whole result (selectinload), instead of up to four lazy
+# loads per file, and searches filter on the indexed FileSummary table.
+
+def track_loaders():
+    return [selectinload(LibraryFile.general_tracks), selectinload(LibraryFile.video_tracks),
+            selectinload(LibraryFile.audio_tracks), selectinload(LibraryFile.image_tracks),
+            selectinload(LibraryFile.summary)]
+
+def _present(stmt, path_prefix=None, include_missing=False):
+    if not include_missing:
+        stmt = stmt.where(or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False))
+    if path_prefix is not None:
+        stmt = stmt.where(under_path(LibraryFile.path, path_prefix))
+    return stmt
+
+def list_files(session, path_prefix=None, include_missing=False, load_tracks=True, limit=None, offset=None):
+    # Files ordered by location; with load_tracks the result costs five SELECTs whatever its size
+    stmt = _present(select(LibraryFile), path_prefix, include_missing).order_by(LibraryFile.path, LibraryFile.name)
+    if load_tracks:
+        stmt = stmt.options(*track_loaders())
+    return session.scalars(stmt.limit(limit).offset(offset)).all()
+
+def find_files(session, video_codec=None, min_width=None, min_height=None, min_duration=None, max_duration=None,
+               container_format=None, audio_codec=None, min_audio_channels=None, path_prefix=None,
+               include_missing=False, load_tracks=False, limit=None):
+    # Searches FileSummary. Codecs and formats are compared as MediaInfo reports them
+    # (e.g. "HEVC", "AVC", "Matroska"), durations are in milliseconds.
+    stmt = _present(select(LibraryFile).join(FileSummary, FileSummary.file_key==LibraryFile.id),
+                    path_prefix, include_missing)
+    if video_codec is not None:
+        stmt = stmt.where(FileSummary.video_codec==video_codec)
+    if min_width is not None:
+        stmt = stmt.where(FileSummary.video_width>=min_width)
+    if min_height is not None:
+        stmt = stmt.where(FileSummary.video_height>=min_height)
+    if min_duration is not None:
+        stmt = stmt.where(FileSummary.duration>=min_duration)
+    if max_duration is not None:
+        stmt = stmt.where(FileSummary.duration<=max_duration)
+    if container_format is not None:
+        stmt = stmt.where(FileSummary.container_format==container_format)
+    if audio_codec is not None:
+        stmt = stmt.where(FileSummary.audio_codec==audio_codec)
+    if min_audio_channels is not None:
+        stmt = stmt.where(FileSummary.max_audio_channels>=min_audio_channels)
+    stmt = stmt.options(*track_loaders()) if load_tracks else stmt.options(selectinload(LibraryFile.summary))
+    return session.scalars(stmt.order_by(LibraryFile.path, LibraryFile.name).limit(limit)).all()
+
+def summary_counts(session, column, path_prefix=None):
+    # (value, file count) pairs for a FileSummary column, e.g. summary_counts(session, FileSummary.video_codec)
+    stmt = _present(select(column, func.count()).join(LibraryFile, FileSummary.file_key==LibraryFile.id), path_prefix)
+    return session.execute(stmt.group_by(column).order_by(func.count().desc())).all()
+
+def parse_duration(value):
+    # "2h", "90m", "45s" or plain seconds, returned in milliseconds
+    units = {"H": 3600, "M": 60, "S": 1}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]] * 1000)
+    return int(float(value) * 1000)
+
+def file_record(library_file):
+    summary = library_file.summary
+    record = {"id": library_file.id, "path": os.path.join(library_file.path, library_file.name), "size": library_file.size}
+    if summary is not None:
+        record.update((column.key, getattr(summary, column.key)) for column in FileSummary.__table__.columns
+                      if column.key != "file_key")
+    return record
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the media library")
+    parser.add_argument("--path", help="only consider files below this directory")
+    parser.add_argument("--video-codec", help="video format as reported by MediaInfo, e.g. HEVC")
+    parser.add_argument("--min-width", type=int)
+    parser.add_argument("--min-height", type=int)
+    parser.add_argument("--min-duration", type=parse_duration, help="e.g. 2h, 90m or seconds")
+    parser.add_argument("--max-duration", type=parse_duration)
+    parser.add_argument("--container", help="container format as reported by MediaInfo, e.g. Matroska")
+    parser.add_argument("--audio-codec")
+    parser.add_argument("--min-audio-channels", type=int)
+    parser.add_argument("--include-missing", action="store_true", help="include files missing on disk")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--count-by", choices=[column.key for column in FileSummary.__table__.columns if column.key != "file_key"],
+                        help="print file counts per value of this summary field instead of files")
+    parser.add_argument("--json", action="store_true", help="write the results as JSON")
+    args = parser.parse_args()
+    path_prefix = os.path.abspath(os.path.expanduser(args.path)) if args.path else None
+    with Session(get_engine()) as session:
+        if args.count_by:
+            results = [{"value": value, "files": count}
+                       for value, count in summary_counts(session, FileSummary.__table__.c[args.count_by], path_prefix)]
+        else:
+            results = [file_record(library_file) for library_file in
+                       find_files(session, args.video_codec, args.min_width, args.min_height, args.min_duration,
+                                  args.max_duration, args.container, args.audio_codec, args.min_audio_channels,
+                                  path_prefix, args.include_missing, limit=args.limit)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif args.count_by:
+        for result in results:
+            sys.stdout.write("%8d  %s\n" % (result["files"], result["value"]))
+    else:
+        for result in results:
+            sys.stdout.write("%s\n" % result["path"])
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import argparse
+import threading
+import collections
+import logging
+import logging.config
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from sqlalchemy.orm import Session
+
+from ScanObjects import CatalogGeneration
+from Base import get_engine, configure
+from Migrations import ensure_schema
+from Aggregates import SUMMARY_AGGREGATES, refresh_aggregates, aggregates_generation, load_aggregate, roll_up_folders
+from Queries import find_files, file_record, parse_duration
+
+logger = logging.getLogger('QueryService')
+
+# Encoded responses kept, across all endpoints and parameters
+CACHE_SIZE = 1024
+# How often the catalog generation is checked; cached responses are at most this stale
+POLL_SECONDS = 1.0
+# Files returned by /files without a limit, and at most with one
+FILES_LIMIT = 100
+MAX_FILES_LIMIT = 1000
+
+class ResultCache:
+    # LRU of encoded responses for one catalog version. A response computed while the
+    # version changed is dropped by put(), so a cleared cache is never refilled with
+    # results from before the change.
+    def __init__(self, size=CACHE_SIZE):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def put(self, key, version, body):
+        with self._lock:
+            if version != self.version or self._size <= 0:
+                return
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def reset(self, version):
+        with self._lock:
+            self._entries.clear()
+            self.version = version
+
+    def __len__(self):
+        return len(self._entries)
+
+def _int_param(params, name, default=None, minimum=0):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("%s must be an integer" % name)
+    if value < minimum:
+        raise ValueError("%s must be at least %d" % (name, minimum))
+    return value
+
+class QueryService:
+    # Answers dashboard queries from the precomputed CatalogAggregate rows and caches
+    # the encoded responses. A poller thread reads the catalog generation (bumped by
+    # every scan commit) and the generation of the aggregates; when either changes the
+    # cache is cleared. Between changes repeated queries are answered from memory.
+    def __init__(self, cache_size=CACHE_SIZE, poll_interval=POLL_SECONDS):
+        self.cache = ResultCache(cache_size)
+        self._poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._poller = None
+        self._routes = {"/generation": self._generation, "/totals": self._totals, "/storage": self._storage,
+                        "/duplicates": self._duplicates, "/files": self._files}
+
+    def start(self):
+        self._poll()
+        self._poller = threading.Thread(target=self._poll_loop, name="GenerationPoller", daemon=True)
+        self._poller.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+
+    def _poll(self):
+        with Session(get_engine()) as session:
+            version = (CatalogGeneration.current(session), aggregates_generation(session))
+        if version != self.cache.version:
+            if self.cache.version is not None:
+                logger.info("Catalog generation %d, aggregates at generation %s, cache cleared", *version)
+            if version[1] is None or version[1] < version[0]:
+                logger.debug("Aggregates lag the catalog (generation %s of %d)", version[1], version[0])
+            self.cache.reset(version)
+
+    def _poll_loop(self):
+        while not self._stop.wait(self._poll_interval):
+            try:
+                self._poll()
+            except Exception:
+                logger.exception("Could not read the catalog generation")
+
+    def handle(self, path, params):
+        # Returns (status, encoded JSON body)
+        route = self._routes.get(path)
+        if route is None:
+            return HTTPStatus.NOT_FOUND, self._encode({"error": "unknown path %s" % path})
+        key = (path, tuple(sorted(params.items())))
+        body = self.cache.get(key)
+        if body is not None:
+            return HTTPStatus.OK, body
+        version = self.cache.version
+        try:
+            result = route(params)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, self._encode({"error": str(e)})
+        result["generation"], result["aggregates_generation"] = version
+        body = self._encode(result)
+        self.cache.put(key, version, body)
+        return HTTPStatus.OK, body
+
+    def _encode(self, result):
+        return json.dumps(result, separators=(",", ":"), default=str).encode()
+
+    def _generation(self, params):
+        return {}
+
+    def _totals(self, params):
+        # Files, bytes and duration per codec, container or video height
+        by = params.get("by", "video_codec")
+        if by not in SUMMARY_AGGREGATES:
+            raise ValueError("by must be one of %s" % ", ".join(SUMMARY_AGGREGATES))
+        with Session(get_engine()) as session:
+            rows = load_aggregate(session, by)
+        rows.sort(key=lambda row: -row[1])
+        return {"by": by, "rows": [{"value": key, "files": files, "bytes": size, "duration": duration}
+                                   for key, files, size, duration in rows]}
+
+    def _storage(self, params):
+        # Files and bytes per directory depth levels below path, whole subtrees included
+        if "path" not in params:
+            raise ValueError("path is required")
+        path = os.path.abspath(os.path.expanduser(params["path"]))
+        depth = _int_param(params, "depth", 1)
+        with Session(get_engine()) as session:
+            rows = load_aggregate(session, "folder")
+        return {"path": path, "depth": depth, "rows": [{"path": bucket, "files": files, "bytes": size}
+                                                       for bucket, files, size in roll_up_folders(rows, path, depth)]}
+
+    def _duplicates(self, params):
+        # Sets of identical files by the bytes removing the extra copies would free
+        limit = _int_param(params, "limit", FILES_LIMIT)
+        with Session(get_engine()) as session:
+            rows = load_aggregate(session, "duplicates")
+        rows.sort(key=lambda row: -(row[2] or 0))
+        return {"sets": len(rows), "files": sum(row[1] for row in rows),
+                "reclaimable_bytes": sum(row[2] or 0 for row in rows),
+                "rows": [{"md5": key, "files": files, "reclaimable_bytes": size} for key, files, size, _ in rows[:limit]]}
+
+    def _files(self, params):
+        # Live search of FileSummary, see Queries.find_files
+        limit = min(_int_param(params, "limit", FILES_LIMIT, 1), MAX_FILES_LIMIT)
+        path = params.get("path")
+        try:
+            min_duration = parse_duration(params["min_duration"]) if "min_duration" in params else None
+            max_duration = parse_duration(params["max_duration"]) if "max_duration" in params else None
+        except ValueError:
+            raise ValueError("durations are given as e.g. 2h, 90m or seconds")
+        with Session(get_engine()) as session:
+            files = find_files(session, params.get("video_codec"), _int_param(params, "min_width"),
+                               _int_param(params, "min_height"), min_duration, max_duration, params.get("container"),
+                               params.get("audio_codec"), _int_param(params, "min_audio_channels"),
+                               os.path.abspath(os.path.expanduser(path)) if path else None, limit=limit)
+            return {"files": [file_record(library_file) for library_file in files]}
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        # A repeated parameter counts once, with its last value
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        started = time.perf_counter()
+        try:
+            status, body = self.service.handle(url.path.rstrip("/") or "/", params)
+        except Exception:
+            logger.exception("Query %s failed", self.path)
+            status, body = HTTPStatus.INTERNAL_SERVER_ERROR, b'{"error":"internal error"}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        logger.debug("%s %d in %.1f ms", self.path, status, (time.perf_counter() - started) * 1000)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+def serve(host="127.0.0.1", port=8080, cache_size=CACHE_SIZE, poll_interval=POLL_SECONDS):
+    service = QueryService(cache_size, poll_interval)
+    service.start()
+    handler = type("Handler", (QueryRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    logger.info("Serving catalog queries on http://%s:%d", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Local HTTP/JSON service for catalog totals, storage and duplicates")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE, help="responses kept in the LRU cache")
+    parser.add_argument("--poll-interval", type=float, default=POLL_SECONDS,
+                        help="seconds between checks of the catalog generation")
+    parser.add_argument("--refresh", action="store_true",
+                        help="rebuild the aggregates before serving, e.g. after scanning with --no-aggregates")
+    args = parser.parse_args()
+    ensure_schema()
+    if args.refresh:
+        refresh_aggregates()
+    # Connections of this process are read-only, so queries never take SQLite's write lock
+    configure(sqlite_query_only="ON")
+    try:
+        serve(args.host, args.port, args.cache_size, args.poll_interval)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,159 @@
+import os
+import logging
+from sqlalchemy import MetaData, Table, Column, String, PrimaryKeyConstraint, select, update, delete, insert, exists, and_, or_
+
+from Tracks import LibraryFile
+from ScanObjects import IgnoredFile, QuarantinedFile, CatalogGeneration
+from Base import get_engine
+from Hashing import md5_file, fingerprint_file
+
+logger = logging.getLogger('FileScanner')
+
+# Seen paths are sent to the temp table in batches of this size
+SEEN_BATCH_SIZE = 5000
+
+temp_metadata = MetaData()
+seen_file = Table("seen_file", temp_metadata,
+                  Column("path", String(500)),
+                  Column("name", String(200)),
+                  PrimaryKeyConstraint("path", "name"),
+                  prefixes=["TEMPORARY"])
+# Directories whose files were all unchanged and therefore not listed individually
+seen_dir = Table("seen_dir", temp_metadata,
+                 Column("path", String(500), primary_key=True),
+                 prefixes=["TEMPORARY"])
+
+def under_path(path_column, root):
+    return or_(path_column==root, path_column.startswith(root.rstrip(os.sep) + os.sep, autoescape=True))
+
+def in_tree(path_column, root, recursive=True):
+    # The directory alone when not recursive, e.g. for shallow work units of a sharded scan
+    return under_path(path_column, root) if recursive else path_column==root
+
+class Reconciler:
+    # Tracks every file seen during a walk in a connection-local temp table, then
+    # reconciles the catalog against it with a few set-based statements. Also
+    # recognises new paths that are moves/renames of files that disappeared.
+    def __init__(self, root_dir, recursive=True):
+        self._root_dir = root_dir
+        self._recursive = recursive
+        self._connection = get_engine().connect()
+        temp_metadata.create_all(self._connection)
+        self._connection.execute(delete(seen_file))
+        self._connection.execute(delete(seen_dir))
+        self._connection.commit()
+        self._seen = []
+        self._seen_dirs = []
+        self._claimed = set()
+
+    def close(self):
+        self._connection.close()
+
+    def seen(self, path, name):
+        self._seen.append({"path": path, "name": name})
+        if len(self._seen) >= SEEN_BATCH_SIZE:
+            self._flush_seen()
+
+    def seen_directory(self, path):
+        self._seen_dirs.append({"path": path})
+        if len(self._seen_dirs) >= SEEN_BATCH_SIZE:
+            self._flush_seen()
+
+    def _flush_seen(self):
+        if self._seen:
+            self._connection.execute(insert(seen_file), self._seen)
+            self._seen = []
+        if self._seen_dirs:
+            self._connection.execute(insert(seen_dir), self._seen_dirs)
+            self._seen_dirs = []
+        self._connection.commit()
+
+    def find_moved(self, session, file_path, stat_result):
+        # Returns the id of a catalog row whose file disappeared and which holds the
+        # same content as file_path, or None. Stat matches need no reads at all;
+        # content is only compared when a single candidate is left.
+        rows = session.execute(select(LibraryFile.id, LibraryFile.path, LibraryFile.name, LibraryFile.mtime_ns,
+                                      LibraryFile.inode, LibraryFile.device, LibraryFile.md5, LibraryFile.fingerprint)
+                               .where(LibraryFile.size==stat_result.st_size)).all()
+        candidates = [row for row in rows if row.id not in self._claimed
+                      and not os.path.lexists(os.path.join(row.path, row.name))]
+        if not candidates:
+            return None
+        name = os.path.basename(file_path)
+        match = None
+        for row in candidates:
+            if (row.inode, row.device, row.mtime_ns) == (stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns):
+                match = row
+                break
+        if match is None:
+            for row in candidates:
+                if row.name == name and row.mtime_ns == stat_result.st_mtime_ns:
+                    match = row
+                    break
+        if match is None and len(candidates) == 1:
+            row = candidates[0]
+            try:
+                if row.fingerprint and fingerprint_file(file_path) == row.fingerprint:
+                    match = row
+                elif not row.fingerprint and row.md5 and md5_file(file_path) == row.md5:
+                    match = row
+            except OSError as e:
+                logger.warning("Could not compare %s with moved candidates: %s", file_path, e)
+        if match is None:
+            return None
+        logger.info("File %s was moved from %s", file_path, os.path.join(match.path, match.name))
+        self._claimed.add(match.id)
+        return match.id
+
+    def mark_removed(self, paths):
+        # Flags rows for deleted files, or for every file below a deleted directory, as
+        # missing on disk and drops their negative cache and quarantine entries
+        missing = 0
+        generation = CatalogGeneration.bump(self._connection) if paths else None
+        for path in paths:
+            directory, name = os.path.split(path)
+            for table in (LibraryFile, IgnoredFile, QuarantinedFile):
+                removed = or_(and_(table.path==directory, table.name==name), under_path(table.path, path))
+                if table is LibraryFile:
+                    missing += self._connection.execute(update(LibraryFile)
+                                                        .where(removed, or_(LibraryFile.missing_on_disk.is_(None),
+                                                                            LibraryFile.missing_on_disk==False))
+                                                        .values(missing_on_disk=True, generation=generation)).rowcount
+                else:
+                    self._connection.execute(delete(table).where(removed))
+        self._connection.commit()
+        if missing:
+            logger.info("%d files removed from disk", missing)
+        return missing
+
+    def reconcile(self):
+        # Must run after the scan's writes are committed
+        self._flush_seen()
+        seen = exists().where(and_(seen_file.c.path==LibraryFile.path, seen_file.c.name==LibraryFile.name))
+        # Rows in unchanged directories keep whatever missing flag they already have
+        unchanged = exists().where(seen_dir.c.path==LibraryFile.path)
+        in_root = in_tree(LibraryFile.path, self._root_dir, self._recursive)
+        now_missing = and_(in_root, or_(LibraryFile.missing_on_disk.is_(None), LibraryFile.missing_on_disk==False), ~seen, ~unchanged)
+        now_found = and_(in_root, LibraryFile.missing_on_disk==True, seen)
+        missing = found = 0
+        # Checked first so a scan that changes nothing does not take a new generation
+        if self._connection.scalar(select(or_(exists().where(now_missing), exists().where(now_found)))):
+            generation = CatalogGeneration.bump(self._connection)
+            missing = self._connection.execute(update(LibraryFile).where(now_missing)
+                                               .values(missing_on_disk=True, generation=generation)).rowcount
+            found = self._connection.execute(update(LibraryFile).where(now_found)
+                                             .values(missing_on_disk=None, generation=generation)).rowcount
+        ignored_seen = or_(exists().where(and_(seen_file.c.path==IgnoredFile.path, seen_file.c.name==IgnoredFile.name)),
+                           exists().where(seen_dir.c.path==IgnoredFile.path))
+        stale = self._connection.execute(delete(IgnoredFile)
+                                         .where(in_tree(IgnoredFile.path, self._root_dir, self._recursive), ~ignored_seen)).rowcount
+        quarantine_seen = or_(exists().where(and_(seen_file.c.path==QuarantinedFile.path, seen_file.c.name==QuarantinedFile.name)),
+                              exists().where(seen_dir.c.path==QuarantinedFile.path))
+        released = self._connection.execute(delete(QuarantinedFile)
+                                            .where(in_tree(QuarantinedFile.path, self._root_dir, self._recursive), ~quarantine_seen)).rowcount
+        self._connection.execute(delete(seen_file))
+        self._connection.execute(delete(seen_dir))
+        self._connection.commit()
+        logger.info("Reconciled %s: %d files missing on disk, %d found again, %d stale non-media and %d stale quarantine entries removed",
+                    self._root_dir, missing, found, stale, released)
+        return missing, found, stale, released
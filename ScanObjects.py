@@ -0,0 +1,223 @@
+from typing import Optional
+from datetime import datetime
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import Integer, BigInteger, String, Boolean, DateTime, LargeBinary, ForeignKey, UniqueConstraint, Index, \
+    select, update, insert
+from sqlalchemy.exc import IntegrityError
+
+from Base import Base, get_id_seq, get_engine
+from Tracks import stat_signature
+
+class IgnoredFile(Base):
+    # Negative cache: files that were probed and found not to be media
+    __tablename__ = "IgnoredFile"
+    id: Mapped[int] = mapped_column(Integer,primary_key=True)
+    name: Mapped[str] = mapped_column(String(200))
+    path: Mapped[str] = mapped_column(String(500))
+    reason: Mapped[Optional[str]] = mapped_column(String(50))
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    mtime_ns: Mapped[Optional[int]] = mapped_column(BigInteger)
+    inode: Mapped[Optional[int]] = mapped_column(BigInteger)
+    device: Mapped[Optional[int]] = mapped_column(BigInteger)
+
+    __table_args__ = (
+        UniqueConstraint("name", "path", name="ux_IgnoredFile_name_path"),
+        Index('ix_IgnoredFile_path', "path"))
+
+    def __init__(self, name, path, stat_result, reason=None):
+        self.id = get_id_seq().next_value()
+        self.name = name
+        self.path = path
+        self.reason = reason
+        self.set_stat(stat_result)
+
+    def set_stat(self, stat_result):
+        self.size, self.mtime_ns, self.inode, self.device = stat_signature(stat_result)
+
+    @property
+    def stat_signature(self):
+        return (self.size, self.mtime_ns, self.inode, self.device)
+
+    @staticmethod
+    def row(name, path, stat_result, reason=None):
+        size, mtime_ns, inode, device = stat_signature(stat_result)
+        return {"id": get_id_seq().next_value(), "name": name, "path": path, "reason": reason,
+                "size": size, "mtime_ns": mtime_ns, "inode": inode, "device": device}
+
+class DirectoryIndex(Base):
+    # Per-directory state from the last scan, used to skip directories that did not change
+    __tablename__ = "DirectoryIndex"
+    id: Mapped[int] = mapped_column(Integer,primary_key=True)
+    path: Mapped[str] = mapped_column(String(500))
+    parent: Mapped[Optional[str]] = mapped_column(String(500))
+    mtime_ns: Mapped[int] = mapped_column(BigInteger)
+    entry_count: Mapped[int] = mapped_column(Integer)
+    # Names and stat signatures of the files directly in the directory
+    files_signature: Mapped[str] = mapped_column(String(40))
+
+    __table_args__ = (
+        UniqueConstraint("path", name="ux_DirectoryIndex_path"),
+        Index('ix_DirectoryIndex_parent', "parent"))
+
+    def __init__(self, **values):
+        self.id = get_id_seq().next_value()
+        self.update(**values)
+
+    def update(self, **values):
+        for key, value in values.items():
+            setattr(self, key, value)
+
+class HashProgress(Base):
+    # Resume point and totals for a background hashing job
+    __tablename__ = "HashProgress"
+    job: Mapped[str] = mapped_column(String(50),primary_key=True)
+    last_file_id: Mapped[int] = mapped_column(Integer)
+    files_hashed: Mapped[int] = mapped_column(BigInteger)
+    bytes_hashed: Mapped[int] = mapped_column(BigInteger)
+    updated: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+class RawMediaInfo(Base):
+    # Compressed MediaInfo XML of a file, so track tables can be rebuilt without re-parsing.
+    # The stat signature is the one of the file the output was taken from.
+    __tablename__ = "RawMediaInfo"
+    file_key: Mapped[int] = mapped_column(Integer, ForeignKey("File.id"), primary_key=True)
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    mtime_ns: Mapped[Optional[int]] = mapped_column(BigInteger)
+    inode: Mapped[Optional[int]] = mapped_column(BigInteger)
+    device: Mapped[Optional[int]] = mapped_column(BigInteger)
+    compression: Mapped[str] = mapped_column(String(10))
+    data: Mapped[bytes] = mapped_column(LargeBinary)
+    archived: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        Index('ix_RawMediaInfo_signature', "size", "mtime_ns"),)
+
+    def __init__(self, file_key, stat_result, data, compression="zlib"):
+        self.file_key = file_key
+        self.update(stat_result, data, compression)
+
+    def update(self, stat_result, data, compression="zlib"):
+        self.set_stat(stat_result)
+        self.data = data
+        self.compression = compression
+        self.archived = datetime.now()
+
+    def set_stat(self, stat_result):
+        self.size, self.mtime_ns, self.inode, self.device = stat_signature(stat_result)
+
+    @staticmethod
+    def row(file_key, stat_result, data, compression="zlib"):
+        size, mtime_ns, inode, device = stat_signature(stat_result)
+        return {"file_key": file_key, "size": size, "mtime_ns": mtime_ns, "inode": inode, "device": device,
+                "compression": compression, "data": data, "archived": datetime.now()}
+
+class QuarantinedFile(Base):
+    # Files whose parse failed, timed out or crashed a worker. Scans skip them until
+    # their stat signature changes; a successful parse removes the entry.
+    __tablename__ = "QuarantinedFile"
+    id: Mapped[int] = mapped_column(Integer,primary_key=True)
+    name: Mapped[str] = mapped_column(String(200))
+    path: Mapped[str] = mapped_column(String(500))
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    mtime_ns: Mapped[Optional[int]] = mapped_column(BigInteger)
+    inode: Mapped[Optional[int]] = mapped_column(BigInteger)
+    device: Mapped[Optional[int]] = mapped_column(BigInteger)
+    error: Mapped[Optional[str]] = mapped_column(String(500))
+    attempts: Mapped[int] = mapped_column(Integer)
+    first_failed: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    last_failed: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint("name", "path", name="ux_QuarantinedFile_name_path"),
+        Index('ix_QuarantinedFile_path', "path"))
+
+    def __init__(self, name, path, stat_result, error):
+        self.id = get_id_seq().next_value()
+        self.name = name
+        self.path = path
+        self.attempts = 0
+        self.first_failed = datetime.now()
+        self.failed(stat_result, error)
+
+    def failed(self, stat_result, error):
+        self.size, self.mtime_ns, self.inode, self.device = stat_signature(stat_result)
+        self.error = error[:500]
+        self.attempts += 1
+        self.last_failed = datetime.now()
+
+class ScanWorkUnit(Base):
+    # A directory of a sharded scan, claimed by one worker at a time under a lease.
+    # state is pending, leased, done or failed; recursive units cover the whole subtree.
+    __tablename__ = "ScanWorkUnit"
+    id: Mapped[int] = mapped_column(Integer,primary_key=True)
+    job: Mapped[str] = mapped_column(String(50))
+    path: Mapped[str] = mapped_column(String(500))
+    recursive: Mapped[bool] = mapped_column(Boolean)
+    state: Mapped[str] = mapped_column(String(10))
+    owner: Mapped[Optional[str]] = mapped_column(String(100))
+    lease_expires: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    attempts: Mapped[int] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(String(500))
+    files_seen: Mapped[Optional[int]] = mapped_column(BigInteger)
+    files_probed: Mapped[Optional[int]] = mapped_column(BigInteger)
+    created: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    finished: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint("job", "path", name="ux_ScanWorkUnit_job_path"),
+        Index('ix_ScanWorkUnit_claim', "job", "state", "lease_expires"))
+
+    @staticmethod
+    def row(job, path, recursive, created):
+        return {"id": get_id_seq().next_value(), "job": job, "path": path, "recursive": recursive, "state": "pending",
+                "attempts": 0, "created": created}
+
+class CatalogGeneration(Base):
+    # Counter bumped by every transaction that changes File rows, which are stamped with
+    # the new value. Incremental exports and query caches compare against it.
+    __tablename__ = "CatalogGeneration"
+    id: Mapped[int] = mapped_column(Integer,primary_key=True)
+    generation: Mapped[int] = mapped_column(BigInteger)
+    updated: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    @staticmethod
+    def bump(connection):
+        # Takes a Session or a Connection. The counter row stays locked until the caller
+        # commits, so generations follow commit order: once generation G is visible,
+        # every change stamped G or lower is too.
+        table = CatalogGeneration.__table__
+        stmt = update(table).where(table.c.id==1).values(generation=table.c.generation + 1, updated=datetime.now())
+
+        def increment():
+            if get_engine().dialect.update_returning:
+                return connection.execute(stmt.returning(table.c.generation)).scalar()
+            if connection.execute(stmt).rowcount:
+                # The UPDATE holds the row lock, so this reads our own increment
+                return connection.scalar(select(table.c.generation).where(table.c.id==1))
+            return None
+
+        generation = increment()
+        if generation is None:
+            try:
+                with connection.begin_nested():
+                    connection.execute(insert(table).values(id=1, generation=1, updated=datetime.now()))
+                return 1
+            except IntegrityError:
+                generation = increment()
+        return generation
+
+    @staticmethod
+    def current(connection):
+        return connection.scalar(select(CatalogGeneration.generation).where(CatalogGeneration.id==1)) or 0
+
+class CatalogAggregate(Base):
+    # Precomputed totals served by QueryService.py, rebuilt by Aggregates.refresh_aggregates.
+    # key is the grouped value ("" for none), e.g. a codec, a directory or an md5.
+    __tablename__ = "CatalogAggregate"
+    aggregate: Mapped[str] = mapped_column(String(30),primary_key=True)
+    key: Mapped[str] = mapped_column(String(500),primary_key=True)
+    files: Mapped[int] = mapped_column(BigInteger)
+    bytes: Mapped[Optional[int]] = mapped_column(BigInteger)
+    duration: Mapped[Optional[int]] = mapped_column(BigInteger)
+    # CatalogGeneration the totals were computed at
+    generation: Mapped[int] = mapped_column(BigInteger)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import heapq
+import cProfile
+import contextlib
+from collections import defaultdict
+
+# Stages timed during a scan. walk/stat/lookup run on the walking thread, parse/hash
+# in the workers, wait is time the writer spends blocked on a worker result and
+# orm/flush/commit/reconcile/aggregate are database work on the writer side.
+STAGES = ("walk", "stat", "lookup", "parse", "hash", "wait", "orm", "flush", "commit", "reconcile", "aggregate")
+# Files kept in the slowest files list
+SLOWEST_FILES = 10
+
+class ScanStats:
+    # Timers and counters for one scan. Only the scanning thread updates it: worker
+    # timings travel back with the probe results, so no locking is needed.
+    def __init__(self, root_dir, expected_files=None):
+        self.root_dir = root_dir
+        self.expected_files = expected_files
+        self.started = time.time()
+        self.finished = None
+        self._start = time.perf_counter()
+        self._last_report = self._start
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.stage_calls = dict.fromkeys(STAGES, 0)
+        self.counters = defaultdict(int)
+        self._slowest = []
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls=1):
+        self.stage_seconds[stage] += seconds
+        self.stage_calls[stage] += calls
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def record_probe(self, file_path, timings):
+        # timings comes from probe_file: {"parse": seconds, "hash": seconds, "bytes": bytes read}
+        self.add_time("parse", timings.get("parse", 0.0))
+        if "hash" in timings:
+            self.add_time("hash", timings["hash"])
+        self.count("files_probed")
+        self.count("bytes_read", timings.get("bytes", 0))
+        seconds = timings.get("parse", 0.0) + timings.get("hash", 0.0)
+        entry = (seconds, file_path)
+        if len(self._slowest) < SLOWEST_FILES:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return end - self._start
+
+    @property
+    def slowest_files(self):
+        return sorted(self._slowest, reverse=True)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def eta(self):
+        # Seconds left, estimated from the catalog size before the scan; None when unknown
+        seen = self.counters["files_seen"]
+        if not self.expected_files or not seen:
+            return None
+        return max(self.expected_files - seen, 0) * self.elapsed / seen
+
+    def progress_line(self):
+        elapsed = self.elapsed
+        seen = self.counters["files_seen"]
+        line = "Scanned %d%s files in %d directories, %d probed (%.1f files/s, %.1f MB/s read), %d added, %d updated" % (
+            seen, "/%d" % self.expected_files if self.expected_files else "", self.counters["directories"],
+            self.counters["files_probed"], seen / elapsed if elapsed else 0.0,
+            self.counters["bytes_read"] / 1024**2 / elapsed if elapsed else 0.0,
+            self.counters["files_added"], self.counters["files_updated"])
+        if self.counters["files_failed"]:
+            line += ", %d failed" % self.counters["files_failed"]
+        if self.counters["files_unreadable"]:
+            line += ", %d unreadable" % self.counters["files_unreadable"]
+        eta = self.eta()
+        if eta is not None:
+            line += ", ETA %s" % _format_seconds(eta)
+        return line
+
+    def report_due(self, interval):
+        now = time.perf_counter()
+        if not interval or now - self._last_report < interval:
+            return False
+        self._last_report = now
+        return True
+
+    def stage_summary(self):
+        return ", ".join("%s %.2fs" % (stage, self.stage_seconds[stage]) for stage in STAGES if self.stage_calls[stage])
+
+    def as_dict(self):
+        return {"root_dir": self.root_dir, "started": self.started, "elapsed_seconds": round(self.elapsed, 3),
+                "expected_files": self.expected_files, "counters": dict(self.counters),
+                "stages": {stage: {"seconds": round(self.stage_seconds[stage], 6), "calls": self.stage_calls[stage]}
+                           for stage in STAGES},
+                "slowest_files": [{"path": file_path, "seconds": round(seconds, 6)} for seconds, file_path in self.slowest_files]}
+
+    def write_json(self, file_path):
+        with _atomic_write(file_path) as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def write_prometheus(self, file_path):
+        # Text exposition format, suitable for node_exporter's textfile collector
+        root = _label_value(self.root_dir)
+        lines = ["# HELP medialibrary_scan_stage_seconds Time spent in each scan stage",
+                 "# TYPE medialibrary_scan_stage_seconds gauge"]
+        lines += ['medialibrary_scan_stage_seconds{root="%s",stage="%s"} %f' % (root, stage, self.stage_seconds[stage])
+                  for stage in STAGES]
+        lines += ["# HELP medialibrary_scan_count Files, directories and bytes handled by the scan",
+                  "# TYPE medialibrary_scan_count gauge"]
+        lines += ['medialibrary_scan_count{root="%s",counter="%s"} %d' % (root, counter, value)
+                  for counter, value in sorted(self.counters.items())]
+        lines += ["# HELP medialibrary_scan_duration_seconds Wall clock duration of the scan",
+                  "# TYPE medialibrary_scan_duration_seconds gauge",
+                  'medialibrary_scan_duration_seconds{root="%s"} %f' % (root, self.elapsed),
+                  "# HELP medialibrary_scan_started_timestamp_seconds Start time of the scan",
+                  "# TYPE medialibrary_scan_started_timestamp_seconds gauge",
+                  'medialibrary_scan_started_timestamp_seconds{root="%s"} %f' % (root, self.started)]
+        with _atomic_write(file_path) as f:
+            f.write("\n".join(lines) + "\n")
+
+@contextlib.contextmanager
+def profiled(file_path):
+    # Runs the enclosed block under cProfile and dumps pstats data to file_path (no-op when None)
+    if file_path is None:
+        yield None
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(file_path)
+
+@contextlib.contextmanager
+def _atomic_write(file_path):
+    # Readers such as the textfile collector never see a half written file
+    tmp_path = "%s.%d.tmp" % (file_path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            yield f
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
@@ -1,46 +1,39 @@
-from sqlalchemy.orm import Mapped, mapped_column, Session
-from sqlalchemy import Integer
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import Integer, select, update, insert
+from sqlalchemy.exc import IntegrityError
 
-from Base import Base,engine
+from Base import Base, get_engine
+from IdAllocator import BlockIdAllocator
 
 class IdSequenceTable(Base):
     __tablename__ = "Id_Sequence"
     id: Mapped[int] = mapped_column(Integer,primary_key=True)
     sequence_value: Mapped[int] = mapped_column(Integer)
 
-class Id_Sequence:
-    def __init__(self):
-        with Session(engine) as session:
-            self.id_seq = session.query(IdSequenceTable).get(1)
-            if self.id_seq is None:
-                self.id_seq = IdSequenceTable(id=1, sequence_value=1)
-                session.add(self.id_seq)
-                session.flush()
-                session.commit()
-        self.fill_pool()
-            #self.current_value = self.id_seq.sequence_value
-            #self.max_id_value = self.current_value + 100
-        #print("Sequence inited with currval: %s maxval: %s" % (self.current_value,self.max_id_value))
-
-    def fill_pool(self):
-        with Session(engine) as session:
-            self.id_seq = session.query(IdSequenceTable).get(1)
-            self.current_value = self.id_seq.sequence_value
-            self.id_seq.sequence_value += 100
-            self.max_id_value = self.id_seq.sequence_value
-            session.flush()
-            session.commit()
-
-
-    def next_value(self):
-        nextval = self.current_value
-        self.current_value += 1
-        #print("Retrieve nextval: %s maxval: %s" % (self.current_value,self.max_id_value))
-        if self.current_value >= self.max_id_value:
-            #print("maxval exceeded, incrementing sequence")
-            self.fill_pool()
-
-
-        return nextval
-
-Base.metadata.create_all(engine)
\ No newline at end of file
+class Id_Sequence(BlockIdAllocator):
+    # Table backed equivalent of Sequence("id_seq", increment=100): sequence_value
+    # is the first id that has not been handed out to any process yet.
+    def _reserve(self, count):
+        # The UPDATE takes the write lock before the new value is read, so the
+        # read-modify-write cannot interleave with another allocator.
+        table = IdSequenceTable.__table__
+        engine = get_engine()
+        stmt = update(table).where(table.c.id==1).values(sequence_value=table.c.sequence_value + count)
+        while True:
+            with engine.begin() as connection:
+                if engine.dialect.update_returning:
+                    end = connection.scalar(stmt.returning(table.c.sequence_value))
+                elif connection.execute(stmt).rowcount:
+                    end = connection.scalar(select(table.c.sequence_value).where(table.c.id==1))
+                else:
+                    end = None
+            if end is not None:
+                return [(end - count, end)]
+            try:
+                # First allocation in this database
+                with engine.begin() as connection:
+                    connection.execute(insert(table).values(id=1, sequence_value=1 + count))
+                return [(1, 1 + count)]
+            except IntegrityError:
+                # Another process created the row first
+                continue
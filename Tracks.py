@@ -1,19 +1,33 @@
 import os
-import hashlib
+import re
+from types import SimpleNamespace
 from typing import List, Optional
 from sqlalchemy.ext.declarative import AbstractConcreteBase
 from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
-from sqlalchemy import Integer, String, Float, ForeignKey, UniqueConstraint, Index, Boolean
+from sqlalchemy import Integer, BigInteger, String, Float, ForeignKey, UniqueConstraint, Index, Boolean
 
-from Base import Base,id_seq, engine
+from Base import Base, get_id_seq
+from Hashing import md5_file
+
+def stat_signature(stat_result):
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_dev)
 
 class LibraryFile(Base):
     __tablename__ = "File"
     id: Mapped[int] = mapped_column(Integer,primary_key=True)
     name: Mapped[str] = mapped_column(String(200))
     path: Mapped[str] = mapped_column(String(500))
-    md5: Mapped[str] = mapped_column(String(50))
+    md5: Mapped[Optional[str]] = mapped_column(String(50))
+    # blake2b over size and sampled blocks, set when ingest defers the full hash
+    fingerprint: Mapped[Optional[str]] = mapped_column(String(64))
     missing_on_disk: Mapped[Optional[bool]] = mapped_column(Boolean)
+    # stat signature from the last time the file was hashed/parsed
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    mtime_ns: Mapped[Optional[int]] = mapped_column(BigInteger)
+    inode: Mapped[Optional[int]] = mapped_column(BigInteger)
+    device: Mapped[Optional[int]] = mapped_column(BigInteger)
+    # CatalogGeneration of the transaction that last changed the row
+    generation: Mapped[Optional[int]] = mapped_column(BigInteger)
     #content_type: Mapped[str] = mapped_column(String(10))
     #content_key
     #part
@@ -24,38 +38,89 @@ class LibraryFile(Base):
     video_tracks: Mapped[List["VideoTrack"]] = relationship(back_populates="file")
     audio_tracks: Mapped[List["AudioTrack"]] = relationship(back_populates="file")
     image_tracks: Mapped[List["ImageTrack"]] = relationship(back_populates="file")
+    summary: Mapped[Optional["FileSummary"]] = relationship(back_populates="file")
 
     __table_args__ = (
         UniqueConstraint("name", "path", name="ux_File_name_path"),
-        Index('ix_File_path', "path"))
+        Index('ix_File_path', "path"),
+        Index('ix_File_md5', "md5"),
+        Index('ix_File_size', "size"),
+        Index('ix_File_fingerprint', "fingerprint"),
+        Index('ix_File_generation', "generation"))
     
-    def __init__(self, name, path):
+    def __init__(self, name, path, md5=None, stat_result=None, fingerprint=None):
         self.name = name
         self.path = path
-        self.id = id_seq.next_value()
+        self.id = get_id_seq().next_value()
+
+        # md5 may already have been computed by a scan worker, or deferred in favour of a fingerprint
+        if md5 is None and fingerprint is None:
+            md5 = md5_file(os.path.join(self.path,self.name))
+        self.md5 = md5
+        self.fingerprint = fingerprint
+        if stat_result is None:
+            stat_result = os.stat(os.path.join(self.path,self.name))
+        self.set_stat(stat_result)
 
-        md5 = hashlib.md5()
-        with open(os.path.join(self.path,self.name), 'rb') as f:
-            while True:
-                data = f.read(65536)
-                if not data:
-                    break
-                md5.update(data)
-        self.md5 = md5.hexdigest()
+    def set_stat(self, stat_result):
+        self.size, self.mtime_ns, self.inode, self.device = stat_signature(stat_result)
+
+    @property
+    def stat_signature(self):
+        return (self.size, self.mtime_ns, self.inode, self.device)
+
+    def move_to(self, name, path):
+        # Re-point the row at a new location, keeping its hash and tracks
+        self.name = name
+        self.path = path
+        file_name, file_extension = os.path.splitext(name)
+        for track in self.general_tracks:
+            track.file_name = file_name
+            track.file_extension = file_extension[1:]
+            track.folder_name = path
+
+    @staticmethod
+    def row(name, path, md5, stat_result, fingerprint=None):
+        # Plain column dict for Core bulk inserts, bypassing the unit of work
+        size, mtime_ns, inode, device = stat_signature(stat_result)
+        return {"id": get_id_seq().next_value(), "name": name, "path": path, "md5": md5, "fingerprint": fingerprint,
+                "missing_on_disk": None, "size": size, "mtime_ns": mtime_ns, "inode": inode, "device": device,
+                "generation": None}
+
+    @staticmethod
+    def track_rows(file_key, media_info, tables=None):
+        # Yields (track table, row) pairs for every track in media_info, optionally only for some tables
+        for track_class, tracks_data in ((GeneralTrack, media_info.general_tracks),
+                                         (VideoTrack, media_info.video_tracks),
+                                         (AudioTrack, media_info.audio_tracks),
+                                         (ImageTrack, media_info.image_tracks)):
+            if tables is not None and track_class.__table__ not in tables:
+                continue
+            for track_data in tracks_data:
+                yield track_class.__table__, track_class.row(file_key, track_data)
 
     def parse_tracks(self,media_info):
-        for track in media_info.general_tracks:
-            t = GeneralTrack(self.id,track)
-            t.file = self
-        for track in media_info.video_tracks:
-            t = VideoTrack(self.id,track)
-            t.file = self
-        for track in media_info.audio_tracks:
-            t = AudioTrack(self.id,track)
-            t.file = self
-        for track in media_info.image_tracks:
-            t = ImageTrack(self.id,track)
+        # Existing track rows are updated in place so their ids survive a rescan
+        self._load_tracks(self.general_tracks, GeneralTrack, media_info.general_tracks)
+        self._load_tracks(self.video_tracks, VideoTrack, media_info.video_tracks)
+        self._load_tracks(self.audio_tracks, AudioTrack, media_info.audio_tracks)
+        self._load_tracks(self.image_tracks, ImageTrack, media_info.image_tracks)
+        if self.summary is None:
+            self.summary = FileSummary(self.id, media_info)
+        else:
+            self.summary.load(media_info)
+
+    def _load_tracks(self, tracks, track_class, tracks_data):
+        for track, track_data in zip(tracks, tracks_data):
+            track.load(track_data)
+        for track_data in tracks_data[len(tracks):]:
+            t = track_class(self.id,track_data)
             t.file = self
+        if len(tracks) > len(tracks_data):
+            session = Session.object_session(self)
+            for track in tracks[len(tracks_data):]:
+                tracks.remove(track)
+                session.delete(track)
 
     @property
     def tracks(self):
@@ -87,6 +152,12 @@ class Track(AbstractConcreteBase, Base):
 
     #file: Mapped["LibraryFile"]# = relationship(back_populates="tracks")
 
+    @classmethod
+    def row(cls,file_key,track_data):
+        # load() only assigns attributes, so it can fill a plain namespace just as well
+        row = SimpleNamespace(id=get_id_seq().next_value(), file_key=file_key)
+        cls.load(row,track_data)
+        return vars(row)
 
 
 class GeneralTrack(Track):
@@ -117,14 +188,20 @@ class GeneralTrack(Track):
     overall_bit_rate_mode: Mapped[Optional[str]] = mapped_column(String(10))
     stream_identifier: Mapped[int] = mapped_column(Integer)
 
+    __table_args__ = (
+        Index('ix_GeneralTrack_file_key', "file_key"),)
+
     __mapper_args__ = {
         "polymorphic_identity": "GeneralTrack",
         "concrete": True,
     }
 
     def __init__(self,file_key,track_data):
-        self.id = id_seq.next_value()
+        self.id = get_id_seq().next_value()
         self.file_key = file_key
+        self.load(track_data)
+
+    def load(self,track_data):
         self.track_id = track_data.track_id or 0
         self.codec = track_data.codec
         self.codec_id = track_data.codec_id
@@ -189,14 +266,20 @@ class VideoTrack(Track):
     resolution: Mapped[Optional[int]] = mapped_column(Integer)
     streamorder: Mapped[Optional[int]] = mapped_column(Integer)
 
+    __table_args__ = (
+        Index('ix_VideoTrack_file_key', "file_key"),)
+
     __mapper_args__ = {
         "polymorphic_identity": "VideoTrack",
         "concrete": True,
     }
 
     def __init__(self,file_key,track_data):
-        self.id = id_seq.next_value()
+        self.id = get_id_seq().next_value()
         self.file_key = file_key
+        self.load(track_data)
+
+    def load(self,track_data):
         self.track_id = track_data.track_id
 
         self.duration = track_data.duration
@@ -275,14 +358,20 @@ class AudioTrack(Track):
     source_stream_size: Mapped[Optional[int]] = mapped_column(Integer)
     source_streamsize_proportion: Mapped[Optional[float]] = mapped_column(Float)
 
+    __table_args__ = (
+        Index('ix_AudioTrack_file_key', "file_key"),)
+
     __mapper_args__ = {
         "polymorphic_identity": "AudioTrack",
         "concrete": True,
     }
 
     def __init__(self,file_key,track_data):
-        self.id = id_seq.next_value()
+        self.id = get_id_seq().next_value()
         self.file_key = file_key
+        self.load(track_data)
+
+    def load(self,track_data):
         self.track_id = track_data.track_id
 
         self.duration = track_data.duration
@@ -340,14 +429,20 @@ class ImageTrack(Track):
     resolution: Mapped[Optional[int]] = mapped_column(Integer)
     stream_identifier: Mapped[Optional[int]] = mapped_column(Integer)
 
+    __table_args__ = (
+        Index('ix_ImageTrack_file_key', "file_key"),)
+
     __mapper_args__ = {
         "polymorphic_identity": "ImageTrack",
         "concrete": True,
     }
 
     def __init__(self,file_key,track_data):
-        self.id = id_seq.next_value()
+        self.id = get_id_seq().next_value()
         self.file_key = file_key
+        self.load(track_data)
+
+    def load(self,track_data):
         self.track_id = track_data.track_id
 
         self.height = track_data.height
@@ -365,6 +460,91 @@ class ImageTrack(Track):
         self.resolution = track_data.resolution
         self.stream_identifier = track_data.stream_identifier
 
+class FileSummary(Base):
+    # One row per media file with the fields most queries filter on, maintained at
+    # ingest so that searches do not need to touch the four track tables
+    __tablename__ = "FileSummary"
+    file_key: Mapped[int] = mapped_column(Integer, ForeignKey("File.id"), primary_key=True)
+
+    file: Mapped["LibraryFile"] = relationship(back_populates="summary")
+
+    container_format: Mapped[Optional[str]] = mapped_column(String(20))
+    # Milliseconds
+    duration: Mapped[Optional[int]] = mapped_column(BigInteger)
+    overall_bit_rate: Mapped[Optional[int]] = mapped_column(BigInteger)
+    # The video track with the largest frame, so cover art does not win over the movie
+    video_codec: Mapped[Optional[str]] = mapped_column(String(20))
+    video_width: Mapped[Optional[int]] = mapped_column(Integer)
+    video_height: Mapped[Optional[int]] = mapped_column(Integer)
+    video_bit_depth: Mapped[Optional[int]] = mapped_column(Integer)
+    video_frame_rate: Mapped[Optional[float]] = mapped_column(Float)
+    # The default audio track, or the first one
+    audio_codec: Mapped[Optional[str]] = mapped_column(String(20))
+    audio_channels: Mapped[Optional[int]] = mapped_column(Integer)
+    max_audio_channels: Mapped[Optional[int]] = mapped_column(Integer)
+    video_track_count: Mapped[int] = mapped_column(Integer)
+    audio_track_count: Mapped[int] = mapped_column(Integer)
+    image_track_count: Mapped[int] = mapped_column(Integer)
+
+    __table_args__ = (
+        Index('ix_FileSummary_video', "video_codec", "video_width", "video_height"),
+        Index('ix_FileSummary_height', "video_height"),
+        Index('ix_FileSummary_duration', "duration"),
+        Index('ix_FileSummary_container', "container_format"),
+        Index('ix_FileSummary_audio', "audio_codec", "audio_channels"))
+
+    def __init__(self,file_key,media_info):
+        self.file_key = file_key
+        self.load(media_info)
+
+    @classmethod
+    def row(cls,file_key,media_info):
+        row = SimpleNamespace(file_key=file_key)
+        cls.load(row,media_info)
+        return vars(row)
+
+    def load(self,media_info):
+        # media_info may also be a LibraryFile, whose track lists carry the same attributes
+        general = media_info.general_tracks[0] if media_info.general_tracks else None
+        video = max(media_info.video_tracks, default=None,
+                    key=lambda track: (_to_int(track.width) or 0) * (_to_int(track.height) or 0))
+        audio = next((track for track in media_info.audio_tracks if track.default == "Yes"),
+                     media_info.audio_tracks[0] if media_info.audio_tracks else None)
+
+        self.container_format = general.format if general is not None else None
+        self.duration = _to_int(general.duration) if general is not None else None
+        if not self.duration:
+            self.duration = max((_to_int(track.duration) or 0 for track in media_info.video_tracks + media_info.audio_tracks),
+                                default=0) or None
+        self.overall_bit_rate = _to_int(general.overall_bit_rate) if general is not None else None
+
+        self.video_codec = video.format if video is not None else None
+        self.video_width = _to_int(video.width) if video is not None else None
+        self.video_height = _to_int(video.height) if video is not None else None
+        self.video_bit_depth = _to_int(video.bit_depth) if video is not None else None
+        self.video_frame_rate = _to_float(video.frame_rate) if video is not None else None
+
+        self.audio_codec = audio.format if audio is not None else None
+        self.audio_channels = _to_int(audio.channel_s) if audio is not None else None
+        self.max_audio_channels = max((_to_int(track.channel_s) or 0 for track in media_info.audio_tracks), default=0) or None
+
+        self.video_track_count = len(media_info.video_tracks)
+        self.audio_track_count = len(media_info.audio_tracks)
+        self.image_track_count = len(media_info.image_tracks)
+
+_NUMBER = re.compile(r"\d+(\.\d+)?")
+
+def _to_int(value):
+    # MediaInfo values can be strings such as "5956.000" or "6 / 2"; the first number wins
+    number = _to_float(value)
+    return int(number) if number is not None else None
+
+def _to_float(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = _NUMBER.search(str(value))
+    return float(match.group()) if match else None
+
 
 Base.registry.configure()
 
@@ -377,7 +557,6 @@ Base.registry.configure()
 #    id: Mapped[int] = mapped_column(Integer,primary_key=True)
 
 
-Base.metadata.create_all(engine)
 
 #gt1 = TestSeq(id=id_seq.next_value())
 #gt2 = TestSeq(id=id_seq.next_value())
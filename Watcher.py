@@ -0,0 +1,274 @@
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import signal
+import ctypes
+import ctypes.util
+import argparse
+import threading
+import logging
+import logging.config
+
+from FileScanner import FileScanner
+from Aggregates import refresh_aggregates
+
+logger = logging.getLogger('Watcher')
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Files are ingested once written and closed, not on creation, so partial downloads are left alone
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+# Longest the main loop sleeps, so stop() is noticed
+POLL_SECONDS = 1.0
+# Wait after a failed scan or aggregate refresh before trying again
+RETRY_SECONDS = 60.0
+
+class Inotify:
+    # Minimal ctypes binding, the standard library has none
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails harmlessly when the kernel already dropped the watch
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        # Yields (wd, mask, cookie, name) for the events queued within timeout seconds
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                yield wd, mask, cookie, name
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    # Keeps the catalog of root_dir current from inotify events. Every directory is
+    # watched; paths touched by events are collected and handed to
+    # FileScanner.scan_paths once no event arrived for debounce seconds (or after
+    # max_delay during a steady stream). A reconciling full scan runs at startup,
+    # whenever the kernel event queue overflowed, since events were lost then, and
+    # RETRY_SECONDS after a scan failed, since the changes it covered were not ingested.
+    def __init__(self, root_dir, debounce=2.0, max_delay=30.0, aggregate_interval=300.0, **scanner_options):
+        self._root_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(root_dir)))
+        if not os.path.isdir(self._root_dir):
+            raise Exception("Invalid Path: %s" % (self._root_dir))
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._scanner_options = scanner_options
+        # Ingested batches rebuild the aggregates at most this often, full scans always do
+        self._aggregate_interval = aggregate_interval
+        self._aggregates_due = None
+        self._rescan_due = None
+        self._stop = threading.Event()
+        self._inotify = None
+        self._watches = {}
+        self._paths = {}
+        self._dirty = set()
+        self._first_event = None
+        self._last_event = None
+        self._watch_limit_logged = False
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        self._inotify = Inotify()
+        try:
+            # Watches go in before the scan, so nothing changing during it is missed
+            self._watch_tree(self._root_dir)
+            self._full_scan("startup")
+            while not self._stop.is_set():
+                timeout = POLL_SECONDS
+                if self._dirty:
+                    due = min(self._last_event + self._debounce, self._first_event + self._max_delay)
+                    timeout = min(timeout, max(due - time.monotonic(), 0))
+                overflowed = False
+                for wd, mask, cookie, name in self._inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        overflowed = True
+                    else:
+                        self._handle(wd, mask, name)
+                if overflowed:
+                    logger.warning("inotify event queue overflowed, rescanning %s", self._root_dir)
+                    self._reset()
+                    self._full_scan("overflow")
+                elif self._rescan_due is not None and time.monotonic() >= self._rescan_due:
+                    self._full_scan("retry after a failed scan")
+                elif self._dirty and time.monotonic() >= min(self._last_event + self._debounce,
+                                                             self._first_event + self._max_delay):
+                    self._flush()
+                elif self._aggregates_due is not None and time.monotonic() >= self._aggregates_due:
+                    self._aggregates_due = None
+                    try:
+                        refresh_aggregates()
+                    except Exception:
+                        logger.exception("Could not refresh the aggregates, retrying in %.0f seconds", RETRY_SECONDS)
+                        self._aggregates_due = time.monotonic() + RETRY_SECONDS
+        finally:
+            self._inotify.close()
+            self._inotify = None
+
+    def _full_scan(self, reason):
+        logger.info("Reconciling scan of %s (%s)", self._root_dir, reason)
+        self._dirty.clear()
+        self._first_event = None
+        self._rescan_due = None
+        try:
+            FileScanner(self._root_dir, **self._scanner_options).scan()
+        except Exception:
+            self._scan_failed("Scan of %s" % self._root_dir)
+            return
+        self._aggregates_due = None
+
+    def _flush(self):
+        paths = sorted(self._dirty)
+        self._dirty.clear()
+        self._first_event = None
+        logger.info("Ingesting %d changed paths", len(paths))
+        try:
+            FileScanner(self._root_dir, **self._scanner_options).scan_paths(paths)
+        except Exception:
+            self._scan_failed("Ingesting %d changed paths" % len(paths))
+            return
+        if self._aggregates_due is None:
+            self._aggregates_due = time.monotonic() + self._aggregate_interval
+
+    def _scan_failed(self, what):
+        # Which of the changes were committed is unknown, the reconciling scan covers them all
+        logger.exception("%s failed, rescanning %s in %.0f seconds", what, self._root_dir, RETRY_SECONDS)
+        if self._rescan_due is None:
+            self._rescan_due = time.monotonic() + RETRY_SECONDS
+
+    def _reset(self):
+        # After an overflow the watch list may be stale as well
+        for wd in list(self._watches):
+            self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._paths.clear()
+        self._watch_tree(self._root_dir)
+
+    def _watch_tree(self, path):
+        # Returns the files found below path, which may predate their directory's watch
+        files = []
+        for directory, dirnames, filenames in os.walk(path):
+            if directory in self._paths:
+                continue
+            try:
+                wd = self._inotify.add_watch(directory)
+            except OSError as e:
+                if e.errno == errno.ENOSPC and not self._watch_limit_logged:
+                    logger.error("Out of inotify watches at %s, raise fs.inotify.max_user_watches; "
+                                 "changes below unwatched directories are only seen by a full scan", directory)
+                    self._watch_limit_logged = True
+                elif e.errno != errno.ENOSPC:
+                    logger.warning("Could not watch %s: %s", directory, e)
+                continue
+            self._watches[wd] = directory
+            self._paths[directory] = wd
+            files.extend(os.path.join(directory, filename) for filename in filenames)
+        return files
+
+    def _unwatch_tree(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        for directory in [directory for directory in self._paths if directory == path or directory.startswith(prefix)]:
+            wd = self._paths.pop(directory)
+            self._watches.pop(wd, None)
+            self._inotify.rm_watch(wd)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_IGNORED:
+            directory = self._watches.pop(wd, None)
+            if directory is not None and self._paths.get(directory) == wd:
+                del self._paths[directory]
+            return
+        directory = self._watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._dirty.update(self._watch_tree(path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+                self._dirty.add(path)
+            else:
+                return
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+            self._dirty.add(path)
+        else:
+            return
+        self._last_event = time.monotonic()
+        if self._first_event is None:
+            self._first_event = self._last_event
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Watch a directory tree and keep the media library current")
+    parser.add_argument("root_dir")
+    parser.add_argument("--debounce", type=float, default=2.0,
+                        help="seconds without events before changed files are ingested")
+    parser.add_argument("--max-delay", type=float, default=30.0,
+                        help="ingest at least this often while events keep arriving")
+    parser.add_argument("--aggregate-interval", type=float, default=300.0,
+                        help="seconds between rebuilds of the QueryService.py aggregates while files keep changing")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of parse/hash workers")
+    parser.add_argument("--fast-hash", action="store_true",
+                        help="store a sampled fingerprint and leave the full md5 to BackgroundHasher.py")
+    parser.add_argument("--parse-timeout", type=float, default=300.0,
+                        help="seconds a file may take to parse before it is quarantined, 0 disables the budget")
+    parser.add_argument("--progress-interval", type=float, default=30.0,
+                        help="seconds between progress lines of the reconciling scans, 0 disables them")
+    args = parser.parse_args()
+    watcher = Watcher(args.root_dir, args.debounce, args.max_delay, args.aggregate_interval, workers=args.workers, fast_hash=args.fast_hash,
+                      parse_timeout=args.parse_timeout or None, progress_interval=args.progress_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,316 @@
+import os
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+import logging
+import logging.config
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, delete, insert, func, and_, or_, case
+from sqlalchemy.orm import Session
+
+from Tracks import LibraryFile
+from ScanObjects import IgnoredFile, DirectoryIndex, QuarantinedFile, ScanWorkUnit
+from Base import get_engine
+from Migrations import ensure_schema
+from Reconcile import Reconciler, under_path
+from FileScanner import FileScanner, ScanCancelled, STALE_DELETE_BATCH
+from Aggregates import refresh_aggregates
+
+logger = logging.getLogger('WorkQueue')
+
+DEFAULT_JOB = "scan"
+# A lease is renewed every third of its length, so a worker must miss two heartbeats to lose it
+LEASE_SECONDS = 300
+# Claims of a unit, including ones whose lease expired, before it is marked failed
+MAX_ATTEMPTS = 3
+# How often an idle worker checks for units released by others
+IDLE_POLL_SECONDS = 10
+
+def _utcnow():
+    # Leases are compared across hosts, so they are kept in UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def default_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+class WorkQueue:
+    # Directory work units of a sharded scan in the ScanWorkUnit table. A unit is
+    # claimed by a single UPDATE ... RETURNING that picks the first claimable row:
+    # atomic on SQLite, where writers are serialized, and on Postgres, where the
+    # subquery's FOR UPDATE SKIP LOCKED makes concurrent workers pick different rows.
+    def __init__(self, job=DEFAULT_JOB, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def plan(self, root_dir, split_depth=2):
+        # Directories above split_depth become units for their own files only, the ones
+        # at split_depth units for their whole subtree. Finished units of an earlier
+        # run under root_dir are replaced, pending or leased ones are kept.
+        ensure_schema()
+        root_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(root_dir)))
+        if not os.path.isdir(root_dir):
+            raise Exception("Invalid Path: %s" % (root_dir))
+        units = []
+        self._split(root_dir, 0, split_depth, units)
+        self._remove_vanished(root_dir)
+        in_root = and_(ScanWorkUnit.job==self.job, under_path(ScanWorkUnit.path, root_dir))
+        with Session(get_engine()) as session:
+            active = set(session.scalars(select(ScanWorkUnit.path).where(in_root, ScanWorkUnit.state.in_(("pending", "leased")))))
+        now = _utcnow()
+        rows = [ScanWorkUnit.row(self.job, path, recursive, now) for path, recursive in units if path not in active]
+        with Session(get_engine()) as session:
+            session.execute(delete(ScanWorkUnit).where(in_root, ScanWorkUnit.state.in_(("done", "failed"))))
+            if rows:
+                session.execute(insert(ScanWorkUnit), rows)
+            session.commit()
+        logger.info("Planned %d work units for %s (%d already queued)", len(rows), root_dir, len(units) - len(rows))
+        return len(rows)
+
+    def _split(self, path, depth, split_depth, units):
+        if depth >= split_depth:
+            units.append((path, True))
+            return
+        units.append((path, False))
+        try:
+            with os.scandir(path) as entries:
+                subdirs = sorted(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except OSError as e:
+            logger.warning("Could not list directory %s: %s", path, e)
+            return
+        for subdir in subdirs:
+            self._split(subdir, depth + 1, split_depth, units)
+
+    def _remove_vanished(self, root_dir):
+        # Directories below the shallow units are only reconciled by a unit that covers
+        # them, so rows of directories deleted since the last scan are handled here
+        with Session(get_engine()) as session:
+            paths = set()
+            for column in (LibraryFile.path, IgnoredFile.path, QuarantinedFile.path, DirectoryIndex.path):
+                paths.update(session.scalars(select(column).where(under_path(column, root_dir)).distinct()))
+        vanished = []
+        for path in sorted(paths):
+            if vanished and path.startswith(vanished[-1].rstrip(os.sep) + os.sep):
+                continue
+            if not os.path.isdir(path):
+                vanished.append(path)
+        if not vanished:
+            return
+        reconciler = Reconciler(root_dir)
+        try:
+            reconciler.mark_removed(vanished)
+        finally:
+            reconciler.close()
+        with Session(get_engine()) as session:
+            for i in range(0, len(vanished), STALE_DELETE_BATCH):
+                session.execute(delete(DirectoryIndex).where(or_(*(under_path(DirectoryIndex.path, path)
+                                                                  for path in vanished[i:i+STALE_DELETE_BATCH]))))
+            session.commit()
+        logger.info("%d directories below %s no longer exist", len(vanished), root_dir)
+
+    def claim(self, owner):
+        # Returns (id, path, recursive) of a unit now leased to owner, or None
+        now = _utcnow()
+        job = ScanWorkUnit.job==self.job
+        expired = and_(ScanWorkUnit.state=="leased", ScanWorkUnit.lease_expires<now)
+        claimable = and_(job, ScanWorkUnit.attempts<self.max_attempts, or_(ScanWorkUnit.state=="pending", expired))
+        candidate = select(ScanWorkUnit.id).where(claimable).order_by(ScanWorkUnit.id).limit(1) \
+            .with_for_update(skip_locked=True)
+        lease = update(ScanWorkUnit).values(state="leased", owner=owner, attempts=ScanWorkUnit.attempts + 1,
+                                            lease_expires=now + timedelta(seconds=self.lease_seconds))
+        columns = (ScanWorkUnit.id, ScanWorkUnit.path, ScanWorkUnit.recursive, ScanWorkUnit.attempts)
+        with get_engine().begin() as connection:
+            abandoned = connection.execute(update(ScanWorkUnit).where(job, expired, ScanWorkUnit.attempts>=self.max_attempts)
+                                           .values(state="failed", error="lease expired on the last attempt")).rowcount
+            if abandoned:
+                logger.warning("%d work units failed after %d expired leases", abandoned, self.max_attempts)
+        with get_engine().begin() as connection:
+            if connection.dialect.update_returning:
+                unit = connection.execute(lease.where(ScanWorkUnit.id==candidate.scalar_subquery(), claimable)
+                                          .returning(*columns)).first()
+            else:
+                # The candidate stays locked until commit, so no other worker can lease it in between
+                unit_id = connection.scalar(candidate)
+                unit = None
+                if unit_id is not None and connection.execute(lease.where(ScanWorkUnit.id==unit_id, claimable)).rowcount:
+                    unit = connection.execute(select(*columns).where(ScanWorkUnit.id==unit_id)).first()
+        if unit is None:
+            return None
+        if unit.attempts > 1:
+            logger.warning("Retrying work unit %s, attempt %d", unit.path, unit.attempts)
+        return unit.id, unit.path, unit.recursive
+
+    def _update_lease(self, unit_id, owner, **values):
+        with Session(get_engine()) as session:
+            updated = session.execute(update(ScanWorkUnit)
+                                      .where(ScanWorkUnit.id==unit_id, ScanWorkUnit.owner==owner, ScanWorkUnit.state=="leased")
+                                      .values(**values).execution_options(synchronize_session=False)).rowcount
+            session.commit()
+        return updated == 1
+
+    def renew(self, unit_id, owner):
+        # False once the lease was taken over by another worker
+        return self._update_lease(unit_id, owner, lease_expires=_utcnow() + timedelta(seconds=self.lease_seconds))
+
+    def complete(self, unit_id, owner, counters):
+        return self._update_lease(unit_id, owner, state="done", lease_expires=None, error=None, finished=_utcnow(),
+                                  files_seen=counters.get("files_seen", 0), files_probed=counters.get("files_probed", 0))
+
+    def fail(self, unit_id, owner, error):
+        # Back to pending until max_attempts claims were used up
+        return self._update_lease(unit_id, owner, lease_expires=None, error=error[:500],
+                                  state=case((ScanWorkUnit.attempts>=self.max_attempts, "failed"), else_="pending"))
+
+    def status(self):
+        with Session(get_engine()) as session:
+            return dict(session.execute(select(ScanWorkUnit.state, func.count()).where(ScanWorkUnit.job==self.job)
+                                        .group_by(ScanWorkUnit.state)).all())
+
+    def active(self):
+        status = self.status()
+        return status.get("pending", 0) + status.get("leased", 0) > 0
+
+class _Heartbeat:
+    def __init__(self, queue, unit_id, owner):
+        self._queue = queue
+        self._unit_id = unit_id
+        self._owner = owner
+        self._stop = threading.Event()
+        self._lost = False
+        self._renewed = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="Heartbeat", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._queue.lease_seconds / 3):
+            try:
+                renewed = self._queue.renew(self._unit_id, self._owner)
+            except Exception as e:
+                logger.warning("Could not renew the lease on work unit %d: %s", self._unit_id, e)
+                continue
+            if not renewed:
+                logger.warning("Lost the lease on work unit %d to another worker", self._unit_id)
+                self._lost = True
+                return
+            self._renewed = time.monotonic()
+
+    @property
+    def lost(self):
+        # Also once the lease ran out without a renewal, another worker may have claimed the unit by then
+        return self._lost or time.monotonic() - self._renewed >= self._queue.lease_seconds
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+class ScanWorker:
+    # Claims units from the queue and scans them with FileScanner until none are left.
+    # A worker whose lease was taken over cancels its scan before its next commit, so
+    # two workers do not insert the same files.
+    def __init__(self, queue, owner=None, wait=False, **scanner_options):
+        self._queue = queue
+        self._owner = owner or default_owner()
+        # Keep polling for new units instead of exiting once the queue is drained
+        self._wait = wait
+        # Aggregates are rebuilt once the queue is drained, not after every unit
+        self._scanner_options = dict(scanner_options, aggregates=False)
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, max_units=None):
+        ensure_schema()
+        done = 0
+        while not self._stop.is_set() and (max_units is None or done < max_units):
+            unit = self._queue.claim(self._owner)
+            if unit is None:
+                # Units leased by others may still expire and need taking over
+                if not self._wait and not self._queue.active():
+                    break
+                self._stop.wait(IDLE_POLL_SECONDS)
+                continue
+            self._scan_unit(*unit)
+            done += 1
+        logger.info("%s scanned %d work units", self._owner, done)
+        if done and not self._queue.active():
+            refresh_aggregates()
+        return done
+
+    def _scan_unit(self, unit_id, path, recursive):
+        logger.info("Scanning work unit %s%s", path, "" if recursive else " (files only)")
+        heartbeat = _Heartbeat(self._queue, unit_id, self._owner)
+        try:
+            if os.path.isdir(path):
+                scanner = FileScanner(path, recursive=recursive, should_stop=lambda: heartbeat.lost,
+                                      **self._scanner_options)
+                scanner.scan()
+                counters = scanner.stats.counters
+            else:
+                # Deleted after planning
+                reconciler = Reconciler(path)
+                try:
+                    reconciler.mark_removed([path])
+                finally:
+                    reconciler.close()
+                counters = {}
+        except ScanCancelled:
+            heartbeat.stop()
+            logger.warning("Abandoned work unit %s, another worker took it over", path)
+            return
+        except Exception as e:
+            logger.exception("Work unit %s failed", path)
+            heartbeat.stop()
+            self._queue.fail(unit_id, self._owner, "%s: %s" % (type(e).__name__, e))
+            return
+        heartbeat.stop()
+        if not self._queue.complete(unit_id, self._owner, counters):
+            logger.warning("Work unit %s was taken over by another worker before it finished", path)
+
+def _work_process(job, lease_seconds, max_attempts, wait, scanner_options):
+    ScanWorker(WorkQueue(job, lease_seconds, max_attempts), wait=wait, **scanner_options).run()
+
+if __name__ == "__main__":
+    WORKING_DIR = os.path.dirname(os.path.realpath(__file__))
+    logging.config.fileConfig(WORKING_DIR+os.sep+'logging.conf')
+    parser = argparse.ArgumentParser(description="Sharded scanning through a work queue shared by several processes or hosts")
+    parser.add_argument("--job", default=DEFAULT_JOB, help="name of the queue, for separate sharded scans")
+    parser.add_argument("--lease-seconds", type=int, default=LEASE_SECONDS,
+                        help="how long a claimed unit stays with a worker that stopped sending heartbeats")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="split a tree into work units")
+    plan_parser.add_argument("root_dir")
+    plan_parser.add_argument("--depth", type=int, default=2,
+                             help="directories at this depth below root_dir become one unit each, with their subtree")
+    work_parser = commands.add_parser("work", help="claim and scan work units")
+    work_parser.add_argument("-p", "--processes", type=int, default=1, help="worker processes on this host")
+    work_parser.add_argument("--wait", action="store_true", help="keep waiting for new units when the queue is empty")
+    work_parser.add_argument("-w", "--workers", type=int, default=1, help="parse/hash workers per process")
+    work_parser.add_argument("--fast-hash", action="store_true",
+                             help="store a sampled fingerprint and leave the full md5 to BackgroundHasher.py")
+    work_parser.add_argument("--parse-timeout", type=float, default=300.0,
+                             help="seconds a file may take to parse before it is quarantined, 0 disables the budget")
+    commands.add_parser("status", help="print unit counts per state")
+    args = parser.parse_args()
+    queue = WorkQueue(args.job, args.lease_seconds, args.max_attempts)
+    if args.command == "plan":
+        queue.plan(args.root_dir, args.depth)
+    elif args.command == "status":
+        ensure_schema()
+        for state, count in sorted(queue.status().items()):
+            print("%-8s %d" % (state, count))
+    else:
+        ensure_schema()
+        scanner_options = {"workers": args.workers, "fast_hash": args.fast_hash,
+                           "parse_timeout": args.parse_timeout or None, "progress_interval": 0}
+        # Not daemonic: workers start parse worker processes of their own
+        processes = [multiprocessing.Process(target=_work_process, name="ScanWorker-%d" % i,
+                                             args=(args.job, args.lease_seconds, args.max_attempts, args.wait, scanner_options))
+                     for i in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()